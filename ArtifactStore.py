@@ -0,0 +1,221 @@
+from contextlib import contextmanager
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+
+class ArtifactStore:
+    """
+    This class keeps the files made for each result, such as the pyLDAvis page,
+    the word cloud and the topic summary, in one directory of bounded size.
+
+    Each artifact is written to a temporary file and moved into place in a
+    single step, so a partially written artifact is never served. Text
+    artifacts are also stored gzip compressed, so they can be sent to clients
+    that accept gzip without being compressed on every request.
+
+    The time an artifact was last served is kept as its access time. When the
+    store grows beyond max_bytes, the least recently used artifacts are
+    removed, and artifacts unused for longer than max_age are removed whatever
+    the size of the store.
+
+    Example Usage:
+    store = ArtifactStore('artifacts', max_bytes = 1024*1024*1024)
+    with store.writing('abcd1.html') as path:
+        pyLDAvis.save_html(vis, path)
+    path, encoding = store.open('abcd1.html', accept_gzip = True)
+    """
+
+    # Artifacts of these types are stored compressed as well
+    COMPRESSED = ('.html', '.json', '.js', '.css', '.txt', '.svg')
+
+    # The prefix of files being written
+    TEMP = '.tmp-'
+
+    # Artifact names are file names without a directory
+    NAME = re.compile(r'^[A-Za-z0-9_-]+\.[A-Za-z0-9]+$')
+
+    def __init__(self, directory = 'artifacts', max_bytes = 1024*1024*1024, max_age = 30*24*60*60):
+        '''
+        Constructor.
+        directory: the directory the artifacts are stored in
+        max_bytes: the maximum total size of the artifacts
+        max_age: the number of seconds after which an unused artifact is removed
+        '''
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        '''
+        This function returns the path of an artifact
+        name: the name of the artifact, e.g. abcd1.html
+        '''
+
+        if not self.NAME.match(name):
+            raise ValueError('invalid artifact name {}'.format(name))
+
+        return os.path.join(self.directory, name)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def age(self, name):
+        '''
+        This function returns the number of seconds since an artifact was written,
+        or None if there is no such artifact
+        name: the name of the artifact
+        '''
+
+        try:
+            return time.time() - os.path.getmtime(self.path(name))
+        except OSError:
+            return None
+
+    @contextmanager
+    def writing(self, name):
+        '''
+        This function gives a temporary path to write an artifact to. When the
+        block ends, the artifact is compressed if it is text and moved into place.
+        name: the name of the artifact
+        '''
+
+        path = self.path(name)
+
+        # The temporary file keeps the extension, since some writers choose the format by it
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix=self.TEMP, suffix=os.path.splitext(name)[1])
+        os.close(fd)
+
+        try:
+            yield temp
+
+            if name.endswith(self.COMPRESSED):
+                fd, compressed = tempfile.mkstemp(dir=self.directory, prefix=self.TEMP, suffix='.gz')
+                try:
+                    # mtime is fixed so the same artifact always compresses the same
+                    with open(temp, 'rb') as f, os.fdopen(fd, 'wb') as raw, \
+                            gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as out:
+                        shutil.copyfileobj(f, out)
+                    os.replace(compressed, path + '.gz')
+                except BaseException:
+                    os.remove(compressed)
+                    raise
+
+            # The uncompressed artifact is moved last, since it marks the artifact as present
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        self.evict()
+
+    def put(self, name, data):
+        '''
+        This function stores an artifact
+        name: the name of the artifact
+        data: bytes. The content of the artifact
+        '''
+
+        with self.writing(name) as temp:
+            with open(temp, 'wb') as f:
+                f.write(data)
+
+    def open(self, name, accept_gzip = False):
+        '''
+        This function finds the file to serve an artifact from and marks the
+        artifact as recently used
+        name: the name of the artifact
+        accept_gzip: whether the client accepts gzip compressed content
+        returns: a tuple of the path and the content encoding (None or 'gzip'), or
+        None if there is no such artifact
+        '''
+
+        path = self.path(name)
+
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        # Only the access time is changed, so the modification time still dates the artifact
+        try:
+            os.utime(path, (time.time(), modified))
+        except OSError:
+            pass
+
+        if accept_gzip and os.path.exists(path + '.gz'):
+            return path + '.gz', 'gzip'
+
+        return path, None
+
+    def entries(self):
+        '''
+        This function lists the stored artifacts as (last used time, size, paths).
+        Files left behind by writers that died are listed as well, once they are
+        an hour old.
+        '''
+
+        entries = []
+        now = time.time()
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+
+            if name.startswith(self.TEMP):
+                try:
+                    if now - os.path.getmtime(path) > 60*60:
+                        entries.append((0, os.path.getsize(path), [path]))
+                except OSError:
+                    pass
+                continue
+
+            if name.endswith('.gz'):
+                continue
+
+            paths = [path, path + '.gz']
+
+            try:
+                used = os.stat(path).st_atime
+                size = sum(os.path.getsize(i) for i in paths if os.path.exists(i))
+            except OSError:
+                continue
+
+            entries.append((used, size, paths))
+
+        return entries
+
+    def evict(self):
+        '''
+        This function removes artifacts unused for longer than max_age and then the
+        least recently used artifacts until the store is no larger than max_bytes
+        '''
+
+        with self.lock:
+            entries = sorted(self.entries())
+            size = sum(i[1] for i in entries)
+            now = time.time()
+
+            for used, length, paths in entries:
+                expired = self.max_age and now - used > self.max_age
+                if not expired and (not self.max_bytes or size <= self.max_bytes):
+                    continue
+
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+                size -= length
+
+            return size
@@ -0,0 +1,179 @@
+from array import array
+import numpy as np
+import os
+
+
+class CompactCorpus:
+    """
+    This class holds a bag of words corpus as three flat arrays, in the
+    compressed sparse row layout: the word ids and counts of all documents one
+    after another, and the offset at which each document starts. This takes
+    12 bytes per distinct word of a document instead of the hundreds of bytes
+    of a list of (id, count) tuples.
+
+    It behaves like the lists of (id, count) tuples gensim expects, so it can be
+    passed to LdaModel, CoherenceModel and pyLDAvis as it is. Documents are
+    turned into tuples one at a time as they are read.
+
+    A corpus saved to a directory can be opened memory-mapped, so its documents
+    are read from disk as needed and shared between the processes that open it.
+
+    Example Usage:
+    corpus = CompactCorpus.fromTexts(texts, id2word)
+    corpus.save('models/results/abcd')
+    corpus = CompactCorpus.load('models/results/abcd')
+    model = gensim.models.ldamodel.LdaModel(corpus=corpus, id2word=id2word)
+    """
+
+    FILES = ('corpus_indptr.npy', 'corpus_indices.npy', 'corpus_data.npy')
+
+    def __init__(self, indptr, indices, data, directory = None):
+        '''
+        Constructor.
+        indptr: the offset of each document in indices and data, followed by the total length
+        indices: the word ids of all documents
+        data: the count of each word id
+        directory: the directory the arrays are memory-mapped from, if any
+        '''
+
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.directory = directory
+
+    @classmethod
+    def fromBow(cls, docs):
+        '''
+        This function creates a corpus from bag of words documents, reading them one
+        at a time
+        docs: an iterable of lists of (id, count) tuples
+        '''
+
+        # Typed buffers, so the corpus is never held as python objects
+        indptr = array('q', [0])
+        indices = array('i')
+        data = array('i')
+
+        for doc in docs:
+            for word_id, count in doc:
+                indices.append(word_id)
+                data.append(count)
+            indptr.append(len(indices))
+
+        return cls(np.frombuffer(indptr, dtype=np.int64), np.frombuffer(indices, dtype=np.int32),
+                   np.frombuffer(data, dtype=np.int32))
+
+    @classmethod
+    def fromTexts(cls, texts, id2word):
+        '''
+        This function creates a corpus from lists of words, reading them one at a time
+        texts: an iterable of lists of words
+        id2word: the gensim dictionary of the words
+        '''
+
+        return cls.fromBow(id2word.doc2bow(text) for text in texts)
+
+    @classmethod
+    def load(cls, directory, mmap = True):
+        '''
+        This function opens a saved corpus
+        directory: the directory the corpus was saved in
+        mmap: read the arrays from disk as needed rather than loading them
+        '''
+
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(directory, name), mmap_mode=mode) for name in cls.FILES]
+
+        return cls(*arrays, directory=os.path.abspath(directory) if mmap else None)
+
+    @classmethod
+    def exists(cls, directory):
+        return all(os.path.exists(os.path.join(directory, name)) for name in cls.FILES)
+
+    def save(self, directory):
+        '''
+        This function saves the corpus. Nothing is written if the corpus is already
+        memory-mapped from the directory.
+        directory: the directory to save the corpus in
+        '''
+
+        if self.directory == os.path.abspath(directory):
+            return
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Another process may have the files memory-mapped, and truncating a mapped file
+        # crashes it. New files are written beside them and moved into place, so the
+        # mapped ones are left as they are
+        temps = []
+        try:
+            for name, values in zip(self.FILES, (self.indptr, self.indices, self.data)):
+                temp = os.path.join(directory, '{}.{}.tmp'.format(name, os.getpid()))
+                temps.append(temp)
+                with open(temp, 'wb') as f:
+                    np.save(f, values)
+
+            for name, temp in zip(self.FILES, temps):
+                os.replace(temp, os.path.join(directory, name))
+        except BaseException:
+            for temp in temps:
+                if os.path.exists(temp):
+                    os.remove(temp)
+            raise
+
+    def mmap(self, directory):
+        '''
+        This function saves the corpus and returns it memory-mapped from the directory
+        directory: the directory to save the corpus in
+        '''
+
+        self.save(directory)
+
+        return self.load(directory)
+
+    def __reduce__(self):
+        # A memory-mapped corpus is opened again by the receiving process rather than copied
+        if self.directory is not None:
+            return (self.load, (self.directory,))
+
+        return (self.__class__, (self.indptr, self.indices, self.data))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def document(self, n):
+        '''
+        This function returns a document as a list of (id, count) tuples
+        n: the position of the document
+        '''
+
+        start, end = self.indptr[n], self.indptr[n + 1]
+
+        return list(zip(self.indices[start:end].tolist(), self.data[start:end].tolist()))
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self.document(i) for i in range(*n.indices(len(self)))]
+
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError('document index out of range')
+
+        return self.document(n)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.document(n)
+
+    def termFrequencies(self, num_terms):
+        '''
+        This function returns the number of times each word occurs in the corpus
+        num_terms: the number of words of the dictionary
+        returns: an array indexed by word id
+        '''
+
+        return np.bincount(self.indices, weights=self.data, minlength=num_terms).astype(np.float64)
+
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
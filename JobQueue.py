@@ -0,0 +1,471 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import partial
+import fcntl
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+import traceback
+import metrics
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is at capacity.
+    """
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job when it has been cancelled.
+    """
+
+
+def writeJson(path, data):
+    '''
+    This function writes a json file atomically so that a partially written
+    status is never read
+    path: the path of the file
+    data: a json serialisable object
+    '''
+
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+class JobProgress:
+    """
+    This class is handed to a running job to report its progress. Each call
+    records the current stage of the job in its status file and raises
+    JobCancelled if the job has been cancelled since, so cancellation takes
+    effect at the next progress report.
+
+    Example Usage:
+    progress('scraping', 3, 20)
+    """
+
+    def __init__(self, directory, job_id):
+        '''
+        Constructor.
+        :param directory: the directory of the job status files
+        :param job_id: the id of the job
+        '''
+
+        self.directory = directory
+        self.job_id = job_id
+
+    def __call__(self, stage, done = None, total = None):
+        '''
+        This method records the progress of the job
+        :param stage: the name of the current stage
+        :param done: the number of items of the stage completed
+        :param total: the total number of items of the stage
+        '''
+
+        if os.path.exists(cancelPath(self.directory, self.job_id)):
+            raise JobCancelled(self.job_id)
+
+        updateStatus(self.directory, self.job_id, progress={'stage': stage, 'done': done, 'total': total})
+
+
+def statusPath(directory, job_id):
+    return os.path.join(directory, job_id + '.json')
+
+
+def cancelPath(directory, job_id):
+    return os.path.join(directory, job_id + '.cancel')
+
+
+def readStatus(directory, job_id):
+    '''
+    This function reads the status of a job
+    :param directory: the directory of the job status files
+    :param job_id: the id of the job
+    :returns: the status dictionary, or None if there is no such job
+    '''
+
+    try:
+        with open(statusPath(directory, job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def updateStatus(directory, job_id, **fields):
+    '''
+    This function updates fields of the status of a job, and the time it was last
+    updated. The status is locked while it is read and written, so updates from
+    the job, its queue and cancellations in other processes are not lost.
+    :param directory: the directory of the job status files
+    :param job_id: the id of the job
+    '''
+
+    with open(statusPath(directory, job_id) + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        status = readStatus(directory, job_id) or {'id': job_id}
+        status.update(fields, updated=time.time())
+        writeJson(statusPath(directory, job_id), status)
+
+    return status
+
+
+def limitMemory(limit):
+    '''
+    This function limits the address space of this process and of the processes
+    it starts afterwards. An allocation beyond the limit raises MemoryError.
+    :param limit: the limit in bytes. None or 0 leaves it unlimited
+    '''
+
+    if not limit:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def runJob(directory, job_id, func, args, kwargs, memory_limit = None, isolated = False):
+    '''
+    This function runs a job in a worker process, recording its state as it
+    starts, finishes, fails or is cancelled, along with the time spent in each
+    stage of the job and its peak memory. The job receives a JobProgress as its
+    progress keyword argument.
+    :param directory: the directory of the job status files
+    :param job_id: the id of the job
+    :param func: the function to run. It must be importable by the worker
+    :param memory_limit: the most memory the process may use, in bytes. A job
+    exceeding it fails
+    :param isolated: whether the job runs in a process of its own, so the peak
+    memory of the process is that of the job
+    '''
+
+    progress = JobProgress(directory, job_id)
+    metrics.startJob()
+
+    try:
+        limitMemory(memory_limit)
+
+        # The job may have been cancelled while queued in another web worker
+        progress('starting')
+        updateStatus(directory, job_id, state='running', started=time.time())
+
+        result = func(*args, progress=progress, **kwargs)
+        updateStatus(directory, job_id, state='done', finished=time.time(), result=result,
+                     timings=metrics.finishJob(isolated))
+    except JobCancelled:
+        updateStatus(directory, job_id, state='cancelled', finished=time.time(), timings=metrics.finishJob(isolated))
+    except MemoryError as e:
+        # The memory of the job is released as the exception unwinds, so the status can still be written
+        traceback.print_exc()
+        error = repr(e)
+        if memory_limit:
+            error = 'MemoryError: the job exceeded its memory limit of {} MB'.format(memory_limit // (1024*1024))
+        updateStatus(directory, job_id, state='failed', finished=time.time(), error=error,
+                     timings=metrics.finishJob(isolated))
+    except Exception as e:
+        traceback.print_exc()
+        updateStatus(directory, job_id, state='failed', finished=time.time(), error=repr(e),
+                     timings=metrics.finishJob(isolated))
+    finally:
+        # Make the totals of this process visible to the /metrics route
+        metrics.flush()
+
+
+def runChild(*args):
+    '''
+    This function runs a job in the child process of runIsolated. The child starts
+    with the metrics totals of the worker it was forked from, which are cleared
+    since the worker reports them itself.
+    The arguments are those of runJob.
+    '''
+
+    metrics.reset()
+    runJob(*args, isolated=True)
+
+
+def runIsolated(directory, job_id, func, args, kwargs, memory_limit = None):
+    '''
+    This function runs a job in a new child process of the worker process. All
+    of the memory of the job is returned to the system when the child exits, so
+    the worker does not grow with every job it runs. A child that dies without
+    recording the end of its job, e.g. killed by the kernel for lack of memory,
+    is recorded as failed.
+    The arguments are those of runJob.
+    '''
+
+    process = multiprocessing.Process(target=runChild, args=(directory, job_id, func, args, kwargs, memory_limit))
+    process.start()
+    process.join()
+
+    if process.exitcode:
+        status = readStatus(directory, job_id) or {}
+        if status.get('state') in (None, 'queued', 'running'):
+            updateStatus(directory, job_id, state='failed', finished=time.time(),
+                         error='the job process exited with code {}'.format(process.exitcode))
+
+    # The totals of the child are kept by this worker, rather than in a file per job
+    metrics.absorb(process.pid)
+
+
+class JobQueue:
+    """
+    This class runs long jobs in a pool of worker processes so that the web
+    workers stay free to serve requests. Jobs wait in a bounded queue, and
+    submitting to a full queue raises QueueFull so callers can apply
+    backpressure.
+
+    In the isolated mode each job runs in a short-lived child process of a
+    worker, so the memory a job used is returned to the system when it ends
+    rather than kept by a long-running worker.
+
+    The state of every job is kept in a json file in the job directory, so
+    any web worker can report the status of a job or cancel it, whichever
+    worker it was submitted to. The queue a job was submitted to updates its
+    status every heartbeat seconds until it ends, so a job whose web worker or
+    worker process died is known by its status no longer being updated.
+
+    Example Usage:
+    queue = JobQueue('jobs', workers = 2, max_pending = 10)
+    job_id = queue.submit(functions.LDA, site, url1, url2, ..., job_id = 'abcd')
+    queue.status(job_id)
+    queue.cancel(job_id)
+    """
+
+    def __init__(self, directory = 'jobs', workers = 2, max_pending = 10, stale_after = 10*60, isolated = False,
+                 memory_limit = None, max_age = 7*24*60*60, heartbeat = 60):
+        '''
+        Constructor.
+        :param directory: the directory the job status files are kept in
+        :param workers: the number of jobs run at the same time
+        :param max_pending: the number of jobs that may wait for a worker
+        :param stale_after: the number of seconds after which a job whose status
+        has not been updated is assumed to have died with its worker
+        :param isolated: run each job in a new process that exits when the job ends
+        :param memory_limit: the most memory, in bytes, each process of a job may
+        use. None leaves it unlimited
+        :param max_age: the number of seconds the status of a finished job is kept
+        :param heartbeat: the number of seconds between updates of the status of
+        the unfinished jobs of this queue. It must be well below stale_after
+        '''
+
+        self.directory = directory
+        self.workers = max(1, int(workers))
+        self.max_pending = max(0, int(max_pending))
+        self.stale_after = stale_after
+        self.isolated = isolated
+        self.memory_limit = memory_limit
+        self.max_age = max_age
+        self.heartbeat = heartbeat
+
+        # The last time old job files were removed
+        self.pruned = 0
+
+        # The pool and the heartbeat thread are created on first use, so they are not inherited across a fork
+        self.executor = None
+        self.beating = None
+        self.futures = {}
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def active(self):
+        '''
+        This method returns the number of jobs of this queue that have not finished
+        '''
+
+        self.futures = {k: v for k, v in self.futures.items() if not v.done()}
+
+        return len(self.futures)
+
+    @contextmanager
+    def claim(self, job_id, timeout = 30):
+        '''
+        This method holds a lock on a job id that is shared by every process using
+        the job directory. A lock left behind for longer than the timeout is broken.
+        :param job_id: the id of the job
+        :param timeout: the number of seconds a lock may be held
+        '''
+
+        path = os.path.join(self.directory, job_id + '.lock')
+
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) > timeout:
+                        os.remove(path)
+                except OSError:
+                    pass
+                time.sleep(0.05)
+
+        try:
+            yield
+        finally:
+            # Another process may have broken the lock if it was held too long
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def inFlight(self, job_id):
+        '''
+        This method checks whether a job is queued or running in any process
+        :param job_id: the id of the job
+        '''
+
+        status = self.status(job_id)
+
+        return (status is not None and status.get('state') in ('queued', 'running')
+                and time.time() - status.get('updated', status.get('submitted', 0)) < self.stale_after)
+
+    def submit(self, func, *args, job_id, **kwargs):
+        '''
+        This method queues a job. If a job with the same id is already queued or
+        running, in this or any other process, no new job is queued and the
+        caller shares the result of the existing one.
+        :param func: the function to run. It must accept a progress keyword argument
+        :param job_id: the id of the job
+        :returns: the id of the job
+        '''
+
+        with self.lock, self.claim(job_id):
+            if self.inFlight(job_id):
+                return job_id
+
+            if self.active() >= self.workers + self.max_pending:
+                raise QueueFull('{} jobs are already queued or running'.format(self.active()))
+
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+            if self.beating is None:
+                self.beating = threading.Thread(target=self.beat, daemon=True)
+                self.beating.start()
+
+            # Old job files are removed at most once an hour
+            if self.max_age and time.time() - self.pruned > 60*60:
+                self.pruned = time.time()
+                self.prune()
+
+            if os.path.exists(cancelPath(self.directory, job_id)):
+                os.remove(cancelPath(self.directory, job_id))
+
+            now = time.time()
+            writeJson(statusPath(self.directory, job_id),
+                      {'id': job_id, 'state': 'queued', 'submitted': now, 'updated': now,
+                       'progress': {'stage': 'queued', 'done': None, 'total': None}})
+
+            run = runIsolated if self.isolated else runJob
+            args = (run, self.directory, job_id, func, args, kwargs, self.memory_limit)
+
+            try:
+                future = self.executor.submit(*args)
+            except BrokenProcessPool:
+                # A worker that died, e.g. killed for lack of memory, breaks the pool for good
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                future = self.executor.submit(*args)
+
+            future.add_done_callback(partial(self.finished, job_id))
+            self.futures[job_id] = future
+
+        return job_id
+
+    def finished(self, job_id, future):
+        '''
+        This method is called when the future of a job is done. A job that ended
+        without recording its end, because its worker process died and broke the
+        pool, is recorded as failed, as are the other jobs of the broken pool.
+        :param job_id: the id of the job
+        :param future: the future of the job
+        '''
+
+        if future.cancelled() or future.exception() is None:
+            return
+
+        status = self.status(job_id) or {}
+        if status.get('state') in (None, 'queued', 'running'):
+            updateStatus(self.directory, job_id, state='failed', finished=time.time(),
+                         error='the job worker process died: {!r}'.format(future.exception()))
+
+    def beat(self):
+        '''
+        This method updates the status of the unfinished jobs of this queue every
+        heartbeat seconds, showing they are still queued or running
+        '''
+
+        while True:
+            time.sleep(self.heartbeat)
+
+            for job_id, future in list(self.futures.items()):
+                if not future.done():
+                    try:
+                        updateStatus(self.directory, job_id)
+                    except OSError:
+                        traceback.print_exc()
+
+    def prune(self):
+        '''
+        This method removes the files of jobs that finished more than max_age seconds
+        ago, or that were abandoned, and files left behind by interrupted writes
+        '''
+
+        now = time.time()
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+
+            # Status files are rewritten while a job runs, so an old one is finished or abandoned
+            if age > max(self.max_age, self.stale_after) or (name.startswith('tmp') and age > 60*60):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def status(self, job_id):
+        '''
+        This method returns the status of a job, or None if there is no such job
+        :param job_id: the id of the job
+        '''
+
+        return readStatus(self.directory, job_id)
+
+    def cancel(self, job_id):
+        '''
+        This method cancels a job. A queued job of this queue is removed from the
+        queue, any other job stops at its next progress report.
+        :param job_id: the id of the job
+        :returns: the status of the job, or None if there is no such job
+        '''
+
+        status = self.status(job_id)
+        if status is None or status.get('state') in ('done', 'failed', 'cancelled'):
+            return status
+
+        future = self.futures.get(job_id)
+        if future is not None and future.cancel():
+            return updateStatus(self.directory, job_id, state='cancelled', finished=time.time())
+
+        open(cancelPath(self.directory, job_id), 'w').close()
+
+        return updateStatus(self.directory, job_id, cancelling=True)
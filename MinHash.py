@@ -0,0 +1,114 @@
+import numpy as np
+import zlib
+
+# The hash functions are (a*x + b) mod this prime, as in the MinHash literature
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+class MinHashLSH:
+    """
+    This class finds documents that are near duplicates of earlier ones. Each
+    document is reduced to a MinHash signature of its word shingles, whose
+    entries agree with those of another document with a probability equal to
+    the Jaccard similarity of their shingles. The signatures are split into
+    bands, and documents sharing any band are compared by the fraction of
+    agreeing entries, so only likely duplicates are ever compared.
+
+    Example Usage:
+    lsh = MinHashLSH(threshold = 0.9)
+    keep = [not lsh.seen(words) for words in cleaned]
+    """
+
+    def __init__(self, threshold = 0.9, num_perm = 64, bands = 16, shingle = 3, seed = 1):
+        '''
+        Constructor.
+        threshold: the estimated Jaccard similarity above which a document is a
+        near duplicate
+        num_perm: the length of the signatures
+        bands: the number of bands the signatures are split into. More bands find
+        more candidates of lower similarity
+        shingle: the number of consecutive words of each shingle
+        seed: the seed of the hash functions
+        '''
+
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle = shingle
+
+        random = np.random.RandomState(seed)
+        self.a = random.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = random.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+        # One dictionary per band, of band values to the signatures of the documents kept
+        self.buckets = [{} for _ in range(bands)]
+
+    def shingles(self, words):
+        '''
+        This function returns the 32 bit hashes of the shingles of a document.
+        Documents shorter than a shingle are a single shingle.
+        words: the document as a list of words
+        '''
+
+        k = min(self.shingle, len(words))
+        grams = {' '.join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+        # crc32 is the same in every process, unlike hash()
+        return np.fromiter((zlib.crc32(i.encode('utf-8')) for i in grams), dtype=np.uint64, count=len(grams))
+
+    def signature(self, words):
+        '''
+        This function returns the MinHash signature of a document
+        words: the document as a list of words
+        '''
+
+        hashes = self.shingles(words)
+
+        # The products may wrap around, which only makes the hash functions a little less uniform
+        with np.errstate(over='ignore'):
+            values = (np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME & MAX_HASH
+
+        return values.min(axis=0)
+
+    def seen(self, words):
+        '''
+        This function checks whether a document is a near duplicate of a document
+        seen before. If not, the document is remembered.
+        words: the document as a list of words
+        returns: True if the document is a near duplicate
+        '''
+
+        if not words:
+            return False
+
+        signature = self.signature(words)
+        keys = [signature[i*self.rows:(i + 1)*self.rows].tobytes() for i in range(self.bands)]
+
+        for band, key in zip(self.buckets, keys):
+            for other in band.get(key, ()):
+                if np.mean(signature == other) >= self.threshold:
+                    return True
+
+        for band, key in zip(self.buckets, keys):
+            band.setdefault(key, []).append(signature)
+
+        return False
+
+
+def nearDuplicates(docs, threshold = 0.9, **kwargs):
+    '''
+    This function finds the documents that are near duplicates of an earlier document
+    docs: an iterable of documents as lists of words
+    threshold: the estimated Jaccard similarity above which a document is a near duplicate
+    kwargs: further arguments of MinHashLSH
+    returns: a boolean array, True for each near duplicate
+    '''
+
+    lsh = MinHashLSH(threshold, **kwargs)
+
+    return np.array([lsh.seen(words) for words in docs], dtype=bool)
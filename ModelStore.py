@@ -0,0 +1,505 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from CompactCorpus import CompactCorpus
+import fcntl
+import gensim
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+def listingKey(site, url1, url2):
+    '''
+    This function returns the key the state of a listing is stored under
+    site: the site the listing is on. i.e. tripadvisor
+    url1: the first part of the listing's urls
+    url2: the second part of the listing's urls
+    '''
+
+    return hashlib.sha1('|'.join([site.lower(), url1, url2]).encode('utf-8')).hexdigest()
+
+
+def reviewHash(text):
+    '''
+    This function returns the hash a review is recognised by
+    text: the text of the review
+    '''
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def newReviews(batches, seen, review_column = 'fullreview', stop = True):
+    '''
+    This function passes on the reviews of each batch that have not been seen
+    before. Reviews are listed newest first, so when the earlier analyses read
+    every page asked for, it stops at the first batch without new reviews and
+    no later pages are fetched.
+    batches: an iterable of review dataframes, such as WebScraper.iterpages()
+    seen: a set of the hashes of the reviews already seen
+    review_column: the name of the review column in the dataframes
+    stop: whether to stop at the first batch without new reviews. When more pages
+    are asked for than were read before, the older pages hold reviews never seen
+    and every batch must be read
+    '''
+
+    try:
+        for batch in batches:
+            # Scrapers that drop repeated reviews have already hashed them
+            hashes = batch['hash'] if 'hash' in batch.columns else batch[review_column].map(reviewHash)
+            fresh = batch[~hashes.isin(seen)]
+            if fresh.empty:
+                if stop:
+                    break
+                continue
+            yield fresh
+    finally:
+        if hasattr(batches, 'close'):
+            batches.close()
+
+
+def saveResult(directory, topicModel):
+    '''
+    This function stores the model of a result so that it can be visualised
+    or used later without training it again. The bigram phrase model and the
+    stopwords are stored with it, so new reviews can be prepared the same way
+    as those the model was trained on.
+    directory: the directory of the result
+    topicModel: the TopicModeling object of the result
+    '''
+
+    from TopicModeling import freezePhrases
+
+    os.makedirs(directory, exist_ok=True)
+
+    # The model may be memory-mapped by processes serving it, so its files are
+    # written beside the stored ones and moved into place rather than written over
+    temp = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+    try:
+        topicModel.ldamodel.save(os.path.join(temp, 'lda'))
+        topicModel.id2word.save(os.path.join(temp, 'dictionary'))
+
+        if topicModel.bigrams is not None:
+            freezePhrases(topicModel.bigrams).save(os.path.join(temp, 'bigrams.phraser'))
+
+        # gensim finds the files of a model by the name it is loaded from, so they can be moved
+        for name in os.listdir(temp):
+            os.replace(os.path.join(temp, name), os.path.join(directory, name))
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+
+    compact(topicModel.corpus).save(directory)
+
+    # The description is written last, since it marks the model as complete
+    temp = os.path.join(directory, 'model.json.tmp')
+    with open(temp, 'w') as f:
+        json.dump({'num_topics': topicModel.ldamodel.num_topics,
+                   'documents': len(topicModel.corpus),
+                   'stopwords': sorted(topicModel.stopwords),
+                   'saved': time.time()}, f)
+    os.replace(temp, os.path.join(directory, 'model.json'))
+
+
+def compact(corpus):
+    '''
+    This function returns a corpus as a CompactCorpus
+    corpus: a bag of words corpus
+    '''
+
+    return corpus if isinstance(corpus, CompactCorpus) else CompactCorpus.fromBow(corpus)
+
+
+def loadCorpus(directory):
+    '''
+    This function opens a stored corpus memory-mapped. Corpora stored before the
+    CompactCorpus format are read from their Matrix Market file.
+    directory: the directory the corpus was stored in
+    '''
+
+    if CompactCorpus.exists(directory):
+        return CompactCorpus.load(directory)
+
+    return CompactCorpus.fromBow(gensim.corpora.MmCorpus(os.path.join(directory, 'corpus.mm')))
+
+
+# The marker file whose modification time is the last time a stored model was used
+USED = '.used'
+
+
+def markUsed(directory):
+    '''
+    This function records that a stored model was used, as the modification time of
+    a marker file in its directory, so pruneDirectories removes the least recently
+    used first. Access times are not used, since listing a directory may change them.
+    directory: the directory of the model
+    '''
+
+    try:
+        with open(os.path.join(directory, USED), 'a'):
+            pass
+        os.utime(os.path.join(directory, USED))
+    except OSError:
+        pass
+
+
+def pruneDirectories(directory, max_bytes = None, max_age = None, keep = 6*60*60):
+    '''
+    This function bounds the disk space of a directory of stored models, such as
+    the results or the listing states. Models unused for longer than max_age are
+    removed, and then the least recently used until the rest take no more than
+    max_bytes. Models changed within the last keep seconds are never removed,
+    since a job may still be writing them.
+    directory: the directory holding a directory for each model
+    max_bytes: the most disk space the models may take. None for no limit
+    max_age: the number of seconds an unused model is kept. None for no limit
+    keep: the number of seconds a changed model is kept whatever the limits
+    returns: the number of bytes the models left take
+    '''
+
+    entries = []
+    now = time.time()
+
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+
+    for name in names:
+        path = os.path.join(directory, name)
+
+        try:
+            if not os.path.isdir(path):
+                continue
+
+            files = {i: os.stat(os.path.join(path, i)) for i in os.listdir(path)}
+            modified = os.path.getmtime(path)
+        except OSError:
+            continue
+
+        marker = files.pop(USED, None)
+        changed = max([i.st_mtime for i in files.values()] + [modified])
+        used = max(changed, marker.st_mtime if marker else 0)
+        entries.append((used, sum(i.st_size for i in files.values()), changed, path))
+
+    entries.sort()
+    size = sum(i[1] for i in entries)
+
+    for used, length, changed, path in entries:
+        expired = max_age and now - used > max_age
+        if not expired and (not max_bytes or size <= max_bytes):
+            continue
+        if now - changed < keep:
+            continue
+
+        shutil.rmtree(path, ignore_errors=True)
+        size -= length
+
+    return size
+
+
+def loadResult(directory):
+    '''
+    This function loads the stored model of a result.
+    directory: the directory of the result
+    returns: a dictionary of the ldamodel, id2word and corpus, or None if the
+    result has no stored model
+    '''
+
+    try:
+        result = {'ldamodel': gensim.models.ldamodel.LdaModel.load(os.path.join(directory, 'lda')),
+                  'id2word': gensim.corpora.Dictionary.load(os.path.join(directory, 'dictionary')),
+                  'corpus': loadCorpus(directory)}
+    except (OSError, ValueError):
+        return None
+
+    markUsed(directory)
+
+    return result
+
+
+def loadModel(directory):
+    '''
+    This function loads what is needed to infer the topics of new reviews with
+    the stored model of a result. The arrays of the model are memory-mapped, so
+    processes that load the same model share them.
+    directory: the directory of the result
+    returns: a dictionary of the ldamodel, id2word, phraser and stopwords, or None
+    if the result has no complete stored model
+    '''
+
+    try:
+        with open(os.path.join(directory, 'model.json')) as f:
+            description = json.load(f)
+
+        model = {'ldamodel': gensim.models.ldamodel.LdaModel.load(os.path.join(directory, 'lda'), mmap='r'),
+                 'id2word': gensim.corpora.Dictionary.load(os.path.join(directory, 'dictionary')),
+                 'phraser': None,
+                 'stopwords': frozenset(description['stopwords'])}
+
+        if os.path.exists(os.path.join(directory, 'bigrams.phraser')):
+            model['phraser'] = gensim.utils.SaveLoad.load(os.path.join(directory, 'bigrams.phraser'))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return model
+
+
+class ModelCache:
+    """
+    This class keeps the most recently used stored models of results loaded, so
+    that inferring the topics of new reviews does not load the model each time.
+    A model is loaded again when its result is saved again.
+
+    Example Usage:
+    models = ModelCache('models/results', size = 8)
+    model = models.get('abcd')
+    """
+
+    def __init__(self, directory, size = 8):
+        '''
+        Constructor.
+        directory: the directory the results are stored in
+        size: the most models kept loaded
+        '''
+
+        self.directory = directory
+        self.size = max(1, int(size))
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        '''
+        This function returns the stored model of a result, as returned by loadModel
+        name: the name the result was saved under
+        returns: the model, or None if the result has no complete stored model
+        '''
+
+        directory = os.path.join(self.directory, name)
+
+        try:
+            saved = os.path.getmtime(os.path.join(directory, 'model.json'))
+        except OSError:
+            return None
+
+        markUsed(directory)
+
+        with self.lock:
+            cached = self.models.get(name)
+            if cached is not None and cached[0] == saved:
+                self.models.move_to_end(name)
+                return cached[1]
+
+        # Loading is slow, so it is done outside the lock. Two requests may load the same model at once
+        model = loadModel(directory)
+        if model is None:
+            return None
+
+        with self.lock:
+            self.models[name] = (saved, model)
+            self.models.move_to_end(name)
+            while len(self.models) > self.size:
+                self.models.popitem(last=False)
+
+        return model
+
+
+def phraserPath(directory, domain):
+    return os.path.join(directory, domain + '.phraser')
+
+
+def loadPhraser(directory, domain):
+    '''
+    This function loads the shared bigram phrase model of a domain, e.g. attractions
+    directory: the directory the phrase models are kept in
+    domain: the name of the domain
+    returns: the frozen phrase model, or None if the domain has none yet
+    '''
+
+    try:
+        return gensim.utils.SaveLoad.load(phraserPath(directory, domain))
+    except (OSError, ValueError):
+        return None
+
+
+def savePhraser(directory, domain, phraser):
+    '''
+    This function stores the shared bigram phrase model of a domain, replacing any
+    previous one in a single step
+    directory: the directory the phrase models are kept in
+    domain: the name of the domain
+    phraser: a frozen phrase model
+    '''
+
+    os.makedirs(directory, exist_ok=True)
+
+    path = phraserPath(directory, domain)
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    phraser.save(temp)
+    os.replace(temp, path)
+
+
+class ListingState:
+    """
+    This class persists what was learnt from the reviews of a listing so that
+    later analyses of the same listing only have to process new reviews. The
+    state is the cleaned reviews, the bigram phrase model, the dictionary,
+    the bag of words corpus and the trained LDA model.
+
+    New reviews are folded into the stored model with online updates, until
+    needsRebuild decides the model has drifted far enough from the reviews it
+    was trained on to be trained again from all of them.
+
+    Example Usage:
+    state = ListingState('models/listings', site, url1, url2)
+    previous = state.load()
+    if previous is None or state.needsRebuild(previous, cleaned):
+        ...
+    state.save(myTopicModel, cleaned, hashes, rebuilt = True)
+    """
+
+    def __init__(self, directory, site, url1, url2, rebuild_fraction = 0.5, max_oov = 0.2,
+                 max_updates = 30, max_age = 30*24*60*60):
+        '''
+        Constructor.
+        directory: the directory the states of all listings are kept in
+        site: the site the listing is on. i.e. tripadvisor
+        url1: the first part of the listing's urls
+        url2: the second part of the listing's urls
+        rebuild_fraction: rebuild once the reviews added since the last rebuild are
+        this fraction of the reviews the model was built from
+        max_oov: rebuild when more than this fraction of the words of the new
+        reviews are not in the dictionary
+        max_updates: rebuild after this many updates
+        max_age: rebuild when the last rebuild is older than this many seconds
+        '''
+
+        self.path = os.path.join(directory, listingKey(site, url1, url2))
+        self.rebuild_fraction = rebuild_fraction
+        self.max_oov = max_oov
+        self.max_updates = max_updates
+        self.max_age = max_age
+
+    def file(self, name, path = None):
+        return os.path.join(path or self.path, name)
+
+    @contextmanager
+    def locked(self, shared = False):
+        '''
+        This function holds the lock of the listing, which is shared by every process.
+        The state is only swapped while the lock is held exclusively.
+        shared: hold it shared, to read the state
+        '''
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        '''
+        This function loads the stored state of the listing.
+        returns: a dictionary of the state, or None if the listing has no state
+        '''
+
+        try:
+            # The lock keeps the state from being swapped while it is read
+            with self.locked(shared=True):
+                with open(self.file('state.json')) as f:
+                    state = json.load(f)
+
+                with open(self.file('cleaned.jsonl')) as f:
+                    state['cleaned'] = [json.loads(line) for line in f]
+
+                state['id2word'] = gensim.corpora.Dictionary.load(self.file('dictionary'))
+                state['bigrams'] = gensim.utils.SaveLoad.load(self.file('bigrams'))
+                state['ldamodel'] = gensim.models.ldamodel.LdaModel.load(self.file('lda'))
+                state['corpus'] = loadCorpus(self.path)
+        except (OSError, ValueError):
+            return None
+
+        state['seen'] = set(state['hashes'])
+        markUsed(self.path)
+
+        return state
+
+    def needsRebuild(self, state, cleaned, numTopics = None):
+        '''
+        This function decides whether the model should be trained again from all
+        reviews rather than updated with the new ones.
+        state: the state returned by load
+        cleaned: the new reviews as lists of words
+        numTopics: the number of topics asked for, or None for any
+        '''
+
+        if numTopics and numTopics != state['ldamodel'].num_topics:
+            return True
+
+        if state['updates'] >= self.max_updates or time.time() - state['rebuilt'] > self.max_age:
+            return True
+
+        if state['docs'] + len(cleaned) - state['docs_at_rebuild'] > self.rebuild_fraction * state['docs_at_rebuild']:
+            return True
+
+        # The model cannot learn words that are not in its dictionary
+        words = [word for doc in cleaned for word in doc]
+        unknown = sum(word not in state['id2word'].token2id for word in words)
+
+        return bool(words) and unknown / len(words) > self.max_oov
+
+    def save(self, topicModel, cleaned, hashes, rebuilt, previous = None, pages = 0):
+        '''
+        This function stores the state of the listing, replacing the previous state
+        in a single step.
+        topicModel: the TopicModeling object the model was built or updated with
+        cleaned: all reviews of the listing as lists of words
+        hashes: the hashes of all reviews of the listing
+        rebuilt: whether the model was trained from all reviews
+        previous: the state returned by load, if the model was updated
+        pages: the number of pages of the listing that were read
+        '''
+
+        # Each save writes to a directory of its own, so saves of the same listing at once do not mix
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = tempfile.mkdtemp(dir=os.path.dirname(self.path), prefix=os.path.basename(self.path) + '.tmp-')
+
+        # A refresh that found no new reviews does not bring the next rebuild closer
+        updated = not rebuilt and len(cleaned) > previous['docs']
+
+        state = {'docs': len(cleaned),
+                 'hashes': hashes,
+                 'updated': time.time(),
+                 'rebuilt': time.time() if rebuilt else previous['rebuilt'],
+                 'docs_at_rebuild': len(cleaned) if rebuilt else previous['docs_at_rebuild'],
+                 'updates': 0 if rebuilt else previous['updates'] + updated,
+                 'pages': max(pages, previous.get('pages', 0) if previous else 0)}
+
+        try:
+            with open(self.file('cleaned.jsonl', temp), 'w') as f:
+                for doc in cleaned:
+                    f.write(json.dumps(doc) + '\n')
+
+            topicModel.id2word.save(self.file('dictionary', temp))
+            topicModel.bigrams.save(self.file('bigrams', temp))
+            topicModel.ldamodel.save(self.file('lda', temp))
+            compact(topicModel.corpus).save(temp)
+
+            with open(self.file('state.json', temp), 'w') as f:
+                json.dump(state, f)
+        except BaseException:
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
+
+        # Swap the new state in for the old one. The last save to finish is kept
+        with self.locked():
+            old = temp + '.old'
+            if os.path.exists(self.path):
+                os.rename(self.path, old)
+            os.rename(temp, self.path)
+            shutil.rmtree(old, ignore_errors=True)
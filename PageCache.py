@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class CacheMiss(KeyError):
+    """
+    Raised when a page that is not in the cache is requested in offline mode.
+    """
+
+
+class PageCache:
+    """
+    This class keeps the raw content of scraped pages on disk so that they
+    do not have to be downloaded again. Each page is stored under the hash
+    of its url, next to a small json file holding the response validators
+    (ETag and Last-Modified) and the time the page was fetched.
+
+    Pages younger than the ttl are served directly. Older pages are revalidated
+    with the server using a conditional request. When the cache grows beyond
+    max_bytes, the least recently used pages are removed.
+
+    Example Usage:
+    cache = PageCache('pagecache', ttl = 3600)
+    ms = WebScraper.WebScraper(url, 'tripadvisor', cache = cache)
+    ms.scrape()
+
+    # Replay without the network
+    ms.cache = PageCache('pagecache', offline = True)
+    ms.scrape()
+    """
+
+    def __init__(self, directory = 'pagecache', ttl = 24*60*60, max_bytes = 500*1024*1024,
+                 max_age = 30*24*60*60, offline = False):
+        """
+        Constructor.
+        directory: the directory the pages are stored in
+        ttl: the number of seconds a page is served without revalidation
+        max_bytes: the maximum total size of the stored pages
+        max_age: the number of seconds after which a page is removed, whether or
+        not it has been used
+        offline: serve pages only from the cache, whatever their age
+        """
+
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.offline = offline
+
+        self.lock = threading.Lock()
+
+        # The total size of the stored pages is computed on first use
+        self.size = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, url):
+        '''
+        This function returns the key a url is stored under
+        url: A string url
+        '''
+
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def paths(self, url):
+        '''
+        This function returns the content and metadata paths of a url
+        url: A string url
+        '''
+
+        key = self.key(url)
+        folder = os.path.join(self.directory, key[:2])
+
+        return os.path.join(folder, key + '.html'), os.path.join(folder, key + '.json')
+
+    def get(self, url):
+        '''
+        This function gets the stored entry of a url.
+        url: A string url
+        returns: a dictionary of the metadata with the page under 'content', or
+        None if the url is not stored
+        '''
+
+        content_path, meta_path = self.paths(url)
+
+        try:
+            with open(meta_path) as f:
+                entry = json.load(f)
+            with open(content_path, 'rb') as f:
+                entry['content'] = f.read()
+        except (OSError, ValueError):
+            return None
+
+        # Mark the page as recently used for eviction. It may have been evicted by another process since
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+
+        return entry
+
+    def isFresh(self, entry):
+        '''
+        This function checks whether an entry can be served without revalidation
+        entry: an entry returned by get
+        '''
+
+        return self.offline or time.time() - entry['fetched'] < self.ttl
+
+    def validators(self, entry):
+        '''
+        This function returns the headers of a conditional request for an entry
+        entry: an entry returned by get, or None
+        '''
+
+        headers = {}
+
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def write(self, path, data):
+        '''
+        This function writes a file atomically so a partially written
+        file is never read
+        path: the path of the file
+        data: bytes to write
+        '''
+
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def put(self, url, content, headers = None):
+        '''
+        This function stores a page.
+        url: A string url
+        content: bytes. The content of the page
+        headers: the response headers, used to get the validators of the page
+        '''
+
+        headers = headers or {}
+        content_path, meta_path = self.paths(url)
+        os.makedirs(os.path.dirname(content_path), exist_ok=True)
+
+        previous = os.path.getsize(content_path) if os.path.exists(content_path) else 0
+
+        meta = {'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'fetched': time.time(),
+                'size': len(content)}
+
+        self.write(content_path, content)
+        self.write(meta_path, json.dumps(meta).encode('utf-8'))
+
+        with self.lock:
+            if self.size is not None:
+                self.size += len(content) - previous
+
+        if self.max_bytes and self.currentSize() > self.max_bytes:
+            self.evict()
+
+    def discard(self, url):
+        '''
+        This function removes a stored page, e.g. one that could not be parsed, so it
+        is fetched again rather than served from the cache
+        url: A string url
+        '''
+
+        content_path, meta_path = self.paths(url)
+
+        # The metadata goes first, since a page without it is never served
+        for path in (meta_path, content_path):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+
+            if path == content_path:
+                with self.lock:
+                    if self.size is not None:
+                        self.size -= size
+
+    def refresh(self, url, entry):
+        '''
+        This function marks a revalidated entry as freshly fetched
+        url: A string url
+        entry: the entry returned by get
+        '''
+
+        meta = {k: v for k, v in entry.items() if k != 'content'}
+        meta['fetched'] = time.time()
+
+        self.write(self.paths(url)[1], json.dumps(meta).encode('utf-8'))
+
+    def entries(self):
+        '''
+        This function lists the stored entries as (last used time, size, content path, metadata path)
+        '''
+
+        entries = []
+
+        for folder, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+
+                meta_path = os.path.join(folder, name)
+                content_path = meta_path[:-len('.json')] + '.html'
+
+                try:
+                    entries.append((os.path.getmtime(meta_path), os.path.getsize(content_path),
+                                    content_path, meta_path))
+                except OSError:
+                    pass
+
+        return entries
+
+    def currentSize(self):
+        '''
+        This function returns the total size of the stored pages
+        '''
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(i[1] for i in self.entries())
+
+            return self.size
+
+    def evict(self):
+        '''
+        This function removes pages older than max_age and then the least recently
+        used pages until the cache is no larger than max_bytes
+        '''
+
+        with self.lock:
+            entries = sorted(self.entries())
+            size = sum(i[1] for i in entries)
+            now = time.time()
+
+            for used, length, content_path, meta_path in entries:
+                expired = self.max_age and now - used > self.max_age
+                if not expired and (not self.max_bytes or size <= self.max_bytes):
+                    continue
+
+                for path in (meta_path, content_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+                size -= length
+
+            self.size = size
@@ -0,0 +1,181 @@
+import hashlib
+import metrics
+import os
+import sqlite3
+import threading
+import time
+
+
+class TokenCache:
+    """
+    This class keeps the cleaned words of reviews in a SQLite database so that
+    reviews cleaned by an earlier job are not cleaned again. Each review is
+    stored under the hash of its text and of the way it was cleaned, so a
+    change of stopwords never returns stale words.
+
+    The time each review was last used is kept, and when the database grows
+    beyond max_bytes the least recently used reviews are removed. Any number of
+    processes can share the database.
+
+    The hits and misses are counted by the token_cache_hits and
+    token_cache_misses metrics, and in the hits and misses of each object.
+
+    Example Usage:
+    cache = TokenCache('models/tokens.sqlite', namespace = 'english')
+    words = cache.getMany(reviews)
+    cache.putMany(reviews, cleaned)
+    """
+
+    # The most parameters of a single SQLite statement
+    BATCH = 500
+
+    def __init__(self, path = 'tokens.sqlite', namespace = '', max_bytes = 256*1024*1024):
+        '''
+        Constructor.
+        path: the path of the database
+        namespace: a name for the way the reviews are cleaned, e.g. a hash of the stopwords
+        max_bytes: the largest size the database may grow to before reviews are removed
+        '''
+
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        # A connection cannot be shared with a forked process or between threads
+        self.local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self.connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, words TEXT NOT NULL, '
+                       'used REAL NOT NULL) WITHOUT ROWID')
+            db.execute('CREATE INDEX IF NOT EXISTS tokens_used ON tokens (used)')
+
+    def connection(self):
+        '''
+        This function returns the connection of this thread and process
+        '''
+
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+
+            # Readers are not blocked by a job writing
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+
+            self.local.db = db
+            self.local.pid = os.getpid()
+
+        return db
+
+    def key(self, text):
+        '''
+        This function returns the key a review is stored under
+        text: the text of the review
+        '''
+
+        return hashlib.sha1((self.namespace + '\0' + text).encode('utf-8')).digest()
+
+    def getMany(self, texts):
+        '''
+        This function looks up the cleaned words of reviews
+        texts: a list of the texts of the reviews
+        returns: a list with the list of words of each review, or None for the
+        reviews that are not stored
+        '''
+
+        keys = [self.key(i) for i in texts]
+        found = {}
+        db = self.connection()
+
+        for start in range(0, len(keys), self.BATCH):
+            batch = keys[start:start + self.BATCH]
+            marks = ','.join('?' * len(batch))
+            found.update(db.execute('SELECT key, words FROM tokens WHERE key IN ({})'.format(marks), batch))
+
+        # Mark the reviews found as recently used for eviction
+        if found:
+            used = list(found)
+            with db:
+                for start in range(0, len(used), self.BATCH):
+                    batch = used[start:start + self.BATCH]
+                    db.execute('UPDATE tokens SET used = ? WHERE key IN ({})'.format(','.join('?' * len(batch))),
+                               [time.time()] + batch)
+
+        hits = sum(i in found for i in keys)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        metrics.count('token_cache_hits', hits)
+        metrics.count('token_cache_misses', len(keys) - hits)
+
+        # The words never contain spaces, so they are stored space separated
+        return [found[i].split() if i in found else None for i in keys]
+
+    def putMany(self, texts, cleaned):
+        '''
+        This function stores the cleaned words of reviews
+        texts: a list of the texts of the reviews
+        cleaned: a list of the list of words of each review
+        '''
+
+        if not texts:
+            return
+
+        now = time.time()
+        rows = [(self.key(text), ' '.join(words), now) for text, words in zip(texts, cleaned)]
+
+        db = self.connection()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO tokens (key, words, used) VALUES (?, ?, ?)', rows)
+
+        if self.max_bytes and self.size() > self.max_bytes:
+            self.evict()
+
+    def size(self):
+        '''
+        This function returns the number of bytes of the database in use
+        '''
+
+        db = self.connection()
+        pages = db.execute('PRAGMA page_count').fetchone()[0] - db.execute('PRAGMA freelist_count').fetchone()[0]
+
+        return pages * db.execute('PRAGMA page_size').fetchone()[0]
+
+    def evict(self, fraction = 0.1):
+        '''
+        This function removes the least recently used reviews until the database is
+        no larger than max_bytes. The space freed is reused by later reviews.
+        fraction: the fraction of the reviews removed at a time
+        '''
+
+        db = self.connection()
+
+        while self.size() > self.max_bytes:
+            count = db.execute('SELECT COUNT(*) FROM tokens').fetchone()[0]
+            if not count:
+                break
+
+            with db:
+                db.execute('DELETE FROM tokens WHERE key IN (SELECT key FROM tokens ORDER BY used LIMIT ?)',
+                           (max(1, int(count * fraction)),))
+
+    def stats(self):
+        '''
+        This function returns the hits, misses and hit rate of this object, and the
+        number of reviews and bytes stored
+        '''
+
+        lookups = self.hits + self.misses
+        db = self.connection()
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'entries': db.execute('SELECT COUNT(*) FROM tokens').fetchone()[0],
+                'bytes': self.size()}
@@ -1,16 +1,363 @@
-import nltk
-nltk.download('stopwords')
 import numpy as np
 import pandas as pd
 import gensim
-from wordcloud import WordCloud
-import pyLDAvis
-import pyLDAvis.gensim
+import hashlib
+import itertools
+import json
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from english_stopwords import ENGLISH_STOPWORDS
+from CompactCorpus import CompactCorpus
+import metrics
 import warnings
 
 print('Fitering Deprecation Warnings!')
 warnings.filterwarnings("ignore",category=DeprecationWarning)
 
+def loadStopwords(source = None):
+	'''
+	This function returns the english stopwords. The bundled list is used unless
+	nltk is asked for, by the source or the STOPWORDS environment variable, in
+	which case the nltk corpus is downloaded if it is missing.
+	:param source: 'bundled' or 'nltk'
+	'''
+
+	source = source or os.environ.get('STOPWORDS', 'bundled')
+
+	if source != 'nltk':
+		return list(ENGLISH_STOPWORDS)
+
+	import nltk
+
+	try:
+		return nltk.corpus.stopwords.words('english')
+	except LookupError:
+		nltk.download('stopwords')
+		return nltk.corpus.stopwords.words('english')
+
+
+def pyLDAvisGensim():
+	'''
+	This function imports pyLDAvis on first use, since it is slow to import and
+	only needed for the visualisation
+	'''
+
+	import pyLDAvis.gensim
+
+	return pyLDAvis.gensim
+
+
+# Recently rendered word clouds, keyed by their frequencies and size
+WORDCLOUD_CACHE_SIZE = 16
+_wordclouds = OrderedDict()
+
+# The tokenizer pattern of gensim.utils.simple_preprocess, compiled once
+ALPHABETIC = re.compile(r'(((?![\d])\w)+)', re.UNICODE)
+
+# Raised whenever cleanText changes, so words cleaned the old way are not reused
+CLEANER_VERSION = 'v1'
+
+# The stopwords of a cleaning worker process
+_worker_stopwords = frozenset()
+
+
+def cleanText(x, stopwords):
+	'''
+	This function cleans a document and turns it in to a list of words. The words
+	are the same as those of gensim.utils.simple_preprocess(x, deacc = True)
+	without the stopwords.
+	:param x: a document (review) as a string
+	:param stopwords: a set of words to leave out
+	'''
+
+	x = gensim.utils.deaccent(gensim.utils.to_unicode(x, errors='ignore').lower())
+
+	return [word for word in (match.group() for match in ALPHABETIC.finditer(x))
+			if 2 <= len(word) <= 15 and not word.startswith('_') and word not in stopwords]
+
+
+def _initCleaner(stopwords):
+	'''
+	This function sets up a cleaning worker process with the stopwords
+	:param stopwords: a set of words to leave out
+	'''
+
+	global _worker_stopwords
+	_worker_stopwords = stopwords
+
+
+def _cleanChunk(docs):
+	'''
+	This function cleans a chunk of documents in a cleaning worker process
+	:param docs: a list of documents as strings
+	'''
+
+	return [cleanText(x, _worker_stopwords) for x in docs]
+
+
+def cleaningPool(stopwords, processes):
+	'''
+	This function creates a pool of processes to clean reviews in, or returns None
+	if reviews are to be cleaned in the calling process. The pool can be shared by
+	any objects with the same stopwords.
+	:param stopwords: a set of words to leave out
+	:param processes: the number of processes
+	'''
+
+	if processes <= 1:
+		return None
+
+	return ProcessPoolExecutor(max_workers=processes, initializer=_initCleaner, initargs=(frozenset(stopwords),))
+
+
+def cleanerKey(stopwords):
+	'''
+	This function returns a name for the way reviews are cleaned with a set of
+	stopwords, for a TokenCache namespace
+	:param stopwords: the stopwords
+	'''
+
+	words = '\n'.join(sorted(stopwords))
+
+	return CLEANER_VERSION + '-' + hashlib.sha1(words.encode('utf-8')).hexdigest()[:16]
+
+
+def freezePhrases(phrases):
+	'''
+	This function returns the frozen form of a phrase model, which only keeps the
+	phrases found and applies them faster. A frozen model is returned as it is.
+	:param phrases: a gensim Phrases or Phraser
+	'''
+
+	if hasattr(phrases, 'add_vocab'):
+		return gensim.models.phrases.Phraser(phrases)
+
+	return phrases
+
+
+def inferTopics(ldamodel, id2word, texts, phraser = None, stopwords = None):
+	'''
+	This function infers the share of each topic in new reviews with a trained
+	model. The reviews are cleaned and their bigrams found the same way as those
+	the model was trained on, and all of them are inferred in one call.
+	:param ldamodel: the trained LDA model
+	:param id2word: the dictionary the model was trained with
+	:param texts: a list of reviews as strings
+	:param phraser: the bigram phrase model the training reviews were prepped with
+	:param stopwords: a set of the stopwords the training reviews were cleaned with
+	:returns: a tuple of an array with a row of topic shares for each review, and
+	the number of words of each review the model knows. A review without known
+	words gets the prior shares of the model.
+	'''
+
+	if stopwords is None:
+		stopwords = frozenset(loadStopwords())
+
+	with metrics.stage('inference', len(texts)):
+		docs = [cleanText(x, stopwords) for x in texts]
+		if phraser is not None:
+			docs = [phraser[doc] for doc in docs]
+
+		bows = [id2word.doc2bow(doc) for doc in docs]
+		if not bows:
+			return np.zeros((0, ldamodel.num_topics)), []
+
+		gamma, _ = ldamodel.inference(bows)
+
+	return gamma / gamma.sum(axis=1, keepdims=True), [sum(count for _, count in bow) for bow in bows]
+
+
+def trainModel(corpus, id2word, numTopics, multicore = False, workers = None):
+	'''
+	This function trains an LDA model
+	:param corpus: the bag of words corpus
+	:param id2word: the dictionary of the corpus
+	:param numTopics: the number of topics
+	:param multicore: whether to train with gensim's LdaMulticore
+	:param workers: the number of LdaMulticore workers
+	'''
+
+	if multicore:
+		# LdaMulticore cannot learn alpha, so a symmetric prior is used
+		return gensim.models.ldamulticore.LdaMulticore(corpus=corpus,
+													id2word=id2word,
+													num_topics=numTopics,
+													workers=workers,
+													random_state=100,
+													chunksize=100,
+													passes=10,
+													alpha='symmetric',
+													per_word_topics=True)
+
+	return gensim.models.ldamodel.LdaModel(corpus=corpus,
+										   id2word=id2word,
+										   num_topics=numTopics,
+										   random_state=100,
+										   update_every=1,
+										   chunksize=100,
+										   passes=10,
+										   alpha='auto',
+										   per_word_topics=True)
+
+
+class CooccurrenceIndex:
+	'''
+	This class holds the word occurrence statistics of a set of texts so that the
+	coherence of any number of models can be scored without re-scanning the texts.
+
+	The texts are split into the same boolean sliding windows as gensim's
+	CoherenceModel, and for every word the set of windows gensim's
+	WordOccurrenceAccumulator counts it in is kept. gensim only counts the windows
+	of texts containing at least one of the words being scored, so the number of
+	windows of each text is kept as well, giving exactly the same probabilities
+	for every model.
+
+	Example Usage:
+	index = CooccurrenceIndex(texts, dictionary, window_size = 110)
+	score = scoreModel(lda_model, texts, dictionary, 'c_v', index)
+	'''
+
+	def __init__(self, texts, dictionary, window_size = 110):
+		'''
+		Constructor.
+		:param texts: a list of lists of words
+		:param dictionary: the gensim dictionary of the texts
+		:param window_size: the size of the sliding windows
+		'''
+
+		self.dictionary = dictionary
+		self.window_size = window_size
+
+		# word id -> the windows containing the word, and the texts containing the word
+		self.windows = {}
+		self.texts = {}
+
+		# The number of windows of each text
+		self.window_counts = []
+
+		token2id = dictionary.token2id
+		first_window = 0
+
+		for n, text in enumerate(texts):
+			length = len(text)
+			count = 1 if length < window_size else length - window_size + 1
+			self.window_counts.append(count if length else 0)
+
+			# The positions of each word in the text
+			positions = {}
+			for p, word in enumerate(text):
+				word_id = token2id.get(word)
+				if word_id is not None:
+					positions.setdefault(word_id, []).append(p)
+
+			for word_id, ps in positions.items():
+				self.texts.setdefault(word_id, set()).add(n)
+				windows = self.windows.setdefault(word_id, set())
+
+				# gensim slides a window along by dropping the word at its left edge, even if the word
+				# occurs again inside the window, then adding the word at its right edge. A word is
+				# counted from the window it enters on the right until the window after it leaves on
+				# the left, and again only once it next enters on the right
+				changes = {p + 1: False for p in ps if p + 1 < count}
+				changes.update((p - window_size + 1, True) for p in ps if p >= window_size)
+
+				counted = ps[0] < window_size
+				start = 0
+				for k in sorted(changes):
+					if counted and not changes[k]:
+						windows.update(range(first_window + start, first_window + k))
+						counted = False
+					elif changes[k] and not counted:
+						start = k
+						counted = True
+
+				if counted:
+					windows.update(range(first_window + start, first_window + count))
+
+			first_window += count
+
+	def accumulator(self, relevant_ids):
+		'''
+		This method returns a gensim accumulator of the statistics of a set of words,
+		as CoherenceModel would have computed them from the texts
+		:param relevant_ids: the ids of the words being scored
+		'''
+
+		from gensim.topic_coherence.text_analysis import InvertedIndexAccumulator
+
+		accumulator = InvertedIndexAccumulator(relevant_ids, self.dictionary)
+
+		# The statistics are set through private attributes, which other gensim versions may not have
+		if not all(hasattr(accumulator, i) for i in ('_inverted_index', '_num_docs', 'id2contiguous')):
+			return None
+
+		for word_id in relevant_ids:
+			accumulator._inverted_index[accumulator.id2contiguous[word_id]] = self.windows.get(word_id, set())
+
+		# Only the windows of texts containing a relevant word are counted
+		relevant_texts = set()
+		for word_id in relevant_ids:
+			relevant_texts.update(self.texts.get(word_id, ()))
+
+		accumulator._num_docs = sum(self.window_counts[i] for i in relevant_texts)
+
+		return accumulator
+
+
+def coherenceIndex(texts, dictionary, coherence = 'c_v', candidates = 1):
+	'''
+	This function returns the CooccurrenceIndex candidate models are scored with,
+	or None if they are scored from the texts. The word co-occurrences are only
+	counted once and shared when several candidates are scored. A single
+	candidate is scored from the texts, without the memory of the index.
+	:param texts: a list of lists of words
+	:param dictionary: the gensim dictionary of the texts
+	:param coherence: the coherence measure
+	:param candidates: the number of candidate models to score
+	'''
+
+	if coherence == 'u_mass' or candidates < 2:
+		return None
+
+	with metrics.stage('cooccurrence_index', len(texts)):
+		return CooccurrenceIndex(texts, dictionary, gensim.models.coherencemodel.SLIDING_WINDOW_SIZES[coherence])
+
+
+def scoreModel(lda_model, texts, id2word, coherence = 'c_v', index = None, corpus = None, processes = -1):
+	'''
+	This function calculates the coherence score of an LDA model
+	:param lda_model: the model to score
+	:param texts: a list of lists of words
+	:param id2word: the dictionary of the texts
+	:param coherence: the coherence measure. 'c_v', 'c_npmi' or 'u_mass'
+	:param index: a CooccurrenceIndex of the texts with the window size of the measure.
+	If not given, the texts are scanned
+	:param corpus: the bag of words corpus, used by u_mass
+	:param processes: the number of processes used to scan the texts
+	'''
+
+	if coherence == 'u_mass':
+		coherence_model_lda = gensim.models.CoherenceModel(model=lda_model,
+				corpus=corpus, dictionary=id2word, coherence='u_mass')
+		return coherence_model_lda.get_coherence()
+
+	coherence_model_lda = gensim.models.CoherenceModel(model=lda_model,
+			texts=texts, dictionary=id2word, coherence=coherence, processes=processes)
+
+	if index is not None:
+		from gensim.topic_coherence.probability_estimation import unique_ids_from_segments
+
+		# Use the shared statistics instead of estimating them from the texts
+		segmented_topics = coherence_model_lda.measure.seg(coherence_model_lda.topics)
+		accumulator = index.accumulator(unique_ids_from_segments(segmented_topics))
+		if accumulator is not None:
+			coherence_model_lda._accumulator = accumulator
+
+	return coherence_model_lda.get_coherence()
+
+
 class TopicModeling:
 	'''
 	This class can be used to carry out LDA and generate word clouds
@@ -23,28 +370,140 @@ class TopicModeling:
 	myTopicModel.generate_wordcloud()
 	'''
 
-	def __init__(self, df, review_column = 'fullreview'):
+	def __init__(self, df, review_column = 'fullreview', copy = True, processes = 1, chunksize = 500,
+				 corpus_dir = None, phraser = None, stopwords = None, token_cache = None):
 		'''
 		Constructure.
 		:param df: this is a dataframe with a column containing reviews
 		:param review_column: the name of the review column in the passed in df
+		:param copy: whether to attach a copy of df rather than df itself, so the
+		columns added by this object do not appear in df
+		:param processes: the number of processes reviews are cleaned in
+		:param chunksize: the number of reviews sent to a cleaning process at a time
+		:param corpus_dir: a directory to keep the corpus in, memory-mapped, rather
+		than in memory
+		:param phraser: a trained bigram phrase model to find bigrams with, such as the
+		shared model of a domain. If not given, one is trained from the reviews
+		:param stopwords: a list of the stopwords, to share them between several
+		objects. If not given, they are loaded
+		:param token_cache: a TokenCache of reviews cleaned before. Only the reviews
+		missing from it are cleaned, and they are then added to it
 		'''
 
 		# Get the stopwords
-		self.stopwords = nltk.corpus.stopwords.words('english')
+		self.stopwords = stopwords if stopwords is not None else loadStopwords()
+		self.stopword_set = frozenset(self.stopwords)
 
-		# Attach a copy of the dataframe to this object
-		self.df = df.copy()
+		self.processes = max(1, int(processes))
+		self.chunksize = chunksize
+		self.token_cache = token_cache
+
+		# Attach a copy of the dataframe to this object. The copy shares the reviews
+		# with df, only the columns added later are its own
+		self.df = df.copy(deep=False) if copy else df
 
 		# Save the column name to be used for the reviews
 		self.review_column = review_column
 
-		# This will be the corpus
+		# This will be the corpus, as a CompactCorpus
 		self.corpus = None
+		self.corpus_dir = corpus_dir
 
 		# This will be the ids of the words
 		self.id2word = None
 
+		# Whether the dictionary was built from exactly the documents of the corpus
+		self.corpus_matches_dictionary = False
+
+		# The bigram phrase model, trained by createGrams unless one is given
+		self.phraser = phraser
+		self.bigrams = phraser
+
+	@classmethod
+	def fromBatches(cls, batches, review_column = 'fullreview', executor = None, **kwargs):
+		'''
+		This method creates an object from an iterable of review dataframes, such as
+		WebScraper.iterpages(), cleaning each batch as soon as it arrives
+		:param batches: an iterable of dataframes with a column containing reviews
+		:param review_column: the name of the review column in the dataframes
+		:param executor: a pool from cleaningPool to share between several objects
+		:param kwargs: further arguments of the constructor
+		'''
+
+		topicModel = cls(pd.DataFrame(columns=[review_column]), review_column, copy=False, **kwargs)
+		topicModel.consume(batches, executor)
+
+		return topicModel
+
+	@classmethod
+	def fromCleaned(cls, cleaned, **kwargs):
+		'''
+		This method creates an object from reviews that have already been cleaned
+		:param cleaned: a list of the list representations of the reviews
+		:param kwargs: further arguments of the constructor
+		'''
+
+		return cls(pd.DataFrame({'cleaned': cleaned}), copy=False, **kwargs)
+
+	def consume(self, batches, executor = None):
+		'''
+		This method cleans each batch of reviews while later batches are still being
+		produced and attaches all of the reviews to this object. The cleaned reviews
+		are kept in the 'cleaned' column for prepdf to find n-grams in.
+		:param batches: an iterable of dataframes with a column containing reviews
+		:param executor: a pool from cleaningPool to clean in. If not given, one is
+		created for these reviews only
+		'''
+
+		frames = []
+		cleaned = []
+
+		owned = executor is None
+		if owned:
+			executor = self.cleaningPool()
+		try:
+			for batch in batches:
+				frames.append(batch)
+				cleaned.extend(self.cleanDocuments(batch[self.review_column], executor))
+		finally:
+			if owned and executor is not None:
+				executor.shutdown()
+
+		if frames:
+			# A single concatenation of the batches, which are then released
+			self.df = pd.concat(frames, ignore_index=True)
+			del frames
+		else:
+			self.df = pd.DataFrame(columns=[self.review_column])
+
+		self.df['cleaned'] = cleaned
+
+	def dropNearDuplicates(self, threshold = 0.9, **kwargs):
+		'''
+		This method drops reviews that are near duplicates of an earlier review, such
+		as the same review posted twice with small edits, by MinHash and LSH over
+		the cleaned words. Reviews are cleaned first if consume has not cleaned them.
+		:param threshold: the estimated Jaccard similarity of the word shingles above
+		which a review is a near duplicate
+		:param kwargs: further arguments of MinHash.MinHashLSH
+		:returns: the number of reviews dropped
+		'''
+
+		from MinHash import nearDuplicates
+
+		if 'cleaned' not in self.df.columns:
+			self.df['cleaned'] = self.cleanDocuments(self.df[self.review_column])
+
+		with metrics.stage('near_duplicates', len(self.df)):
+			duplicates = nearDuplicates(self.df['cleaned'], threshold, **kwargs)
+
+		dropped = int(duplicates.sum())
+		if dropped:
+			metrics.count('near_duplicate_reviews', dropped)
+			self.df = self.df[~duplicates].reset_index(drop=True)
+
+		return dropped
+
 	def cleanDocument(self, x):
 		'''
 		This method takes a document (single review), cleans it and turns
@@ -52,27 +511,89 @@ class TopicModeling:
 		:param x: a document (review) as a string
 		'''
 
-		return [word for word in gensim.utils.simple_preprocess(x,deacc = True)
-				if word not in self.stopwords]
+		return cleanText(x, self.stopword_set)
+
+	def cleaningPool(self):
+		'''
+		This method creates a pool of processes to clean reviews in, or returns
+		None if reviews are to be cleaned in this process
+		'''
+
+		return cleaningPool(self.stopword_set, self.processes)
+
+	def cleanDocuments(self, docs, executor = None):
+		'''
+		This method cleans a list (or series) of documents. With an executor from
+		cleaningPool, the documents are shared out in chunks between its processes.
+		With a token cache, only the documents missing from it are cleaned. The
+		result is the same either way.
+		:param docs: a list (or series) of documents as strings
+		:param executor: a pool from cleaningPool, or None
+		:returns: a list of the list representations of the documents
+		'''
+
+		docs = list(docs)
+
+		if self.token_cache is None:
+			return self.cleanMany(docs, executor)
+
+		# Only the reviews not cleaned before are cleaned
+		cleaned = self.token_cache.getMany(docs)
+		missing = [i for i, words in enumerate(cleaned) if words is None]
+
+		if missing:
+			misses = [docs[i] for i in missing]
+			for i, words in zip(missing, self.cleanMany(misses, executor)):
+				cleaned[i] = words
+			self.token_cache.putMany(misses, [cleaned[i] for i in missing])
+
+		return cleaned
+
+	def cleanMany(self, docs, executor = None):
+		'''
+		This method cleans a list of documents, in the processes of the executor if
+		there is one
+		:param docs: a list of documents as strings
+		:param executor: a pool from cleaningPool, or None
+		'''
 
-	def createGrams(self, ls):
+		with metrics.stage('clean', len(docs)):
+			# Small inputs are not worth sending to other processes
+			if executor is None or len(docs) <= self.chunksize:
+				return [self.cleanDocument(x) for x in docs]
+
+			chunks = [docs[i:i + self.chunksize] for i in range(0, len(docs), self.chunksize)]
+
+			return [words for chunk in executor.map(_cleanChunk, chunks) for words in chunk]
+
+	def createGrams(self, ls, trigrams = False):
 		"""
 		This method expects a list (or series) of lists of words each being a
-		list representation of a document. It returns a list of bigrams and
-		a list of Trigrams relevant to the list given.
+		list representation of a document. It returns a list of bigrams and,
+		if asked for, a list of Trigrams relevant to the list given. If this
+		object was given a phraser, its bigrams are used and none are trained.
 		:param ls: a list (or series) of a list of words
+		:param trigrams: whether to find trigrams as well. If not, None is returned
+		in place of the trigrams
 		"""
 		
-		# Create bigrams (i.e. train the bigrams)
-		bigrams = gensim.models.Phrases(ls, min_count=3, threshold=50)
-		bigrams_Phrases= gensim.models.phrases.Phraser(bigrams)
+		with metrics.stage('ngrams', len(ls)):
+			if self.phraser is None:
+				# Create bigrams (i.e. train the bigrams) in a single pass over the documents.
+				# The full model is kept so it can be stored and updated later
+				self.bigrams = gensim.models.Phrases(ls, min_count=3, threshold=50)
 
-		# Create trigrams (i.e. train the trigrams)
-		trigrams = gensim.models.Phrases(bigrams_Phrases[list(ls)], min_count=3, threshold=50) 
-		trigram_Phrases = gensim.models.phrases.Phraser(trigrams)
+			bigrams_Phrases = freezePhrases(self.bigrams)
+			bigrammed = [bigrams_Phrases[i] for i in ls]
 
-		# Return each document's list representation while considering n-grams
-		return [bigrams_Phrases[i] for i in list(ls)],[trigram_Phrases[i] for i in list(ls)]
+			if not trigrams:
+				return bigrammed, None
+
+			# Create trigrams (i.e. train the trigrams) from the bigrams
+			trigram_Phrases = freezePhrases(gensim.models.Phrases(bigrammed, min_count=3, threshold=50))
+
+			# Return each document's list representation while considering n-grams
+			return bigrammed, [trigram_Phrases[i] for i in bigrammed]
 
 	def cleanAndCreateGrams(self, ls):
 		'''
@@ -81,17 +602,31 @@ class TopicModeling:
 		:param ls: a list (or series) of a list of words
 		'''
 		
-		return(self.createGrams(ls.apply(lambda x: self.cleanDocument(x)))[0])
+		executor = self.cleaningPool()
+		try:
+			cleaned = self.cleanDocuments(ls, executor)
+		finally:
+			if executor is not None:
+				executor.shutdown()
+
+		return(self.createGrams(cleaned)[0])
 
 	def prepdf(self):
 		'''
 		This method prepares the review dataframe attached to this object by cleaning
-		each review and transforming it into list representation
+		each review and transforming it into list representation. Reviews already
+		cleaned by consume are not cleaned again.
 		'''
 		
-		self.df['prepped'] = self.cleanAndCreateGrams(self.df[self.review_column])
+		if 'cleaned' in self.df.columns:
+			self.df['prepped'] = self.createGrams(self.df['cleaned'])[0]
+			del self.df['cleaned']
+		else:
+			self.df['prepped'] = self.cleanAndCreateGrams(self.df[self.review_column])
 
-	def ldaModel(self, x = None, numTopics = None):
+	def ldaModel(self, x = None, numTopics = None, topicRange = (2, 6), processes = 1,
+				 multicore = False, workers = None, patience = None, coherence = 'c_v',
+				 coherenceSample = None, visualise = True):
 		'''
 		This method runs the LDA model on the column containing the reviews in list
 		representation. If the reviews column has not already been prepared, this
@@ -99,6 +634,20 @@ class TopicModeling:
 		column to run LDA on.
 		:param x: a list of lists of words. Each list is expected to have been prepped
 		by removing stopwords and finding n-grams
+		:param numTopics: the number of topics. If not given, models are trained for
+		each number of topics in topicRange and the most coherent one is kept
+		:param topicRange: the (start, stop) range of the numbers of topics to try
+		:param processes: the number of candidate models trained at the same time
+		:param multicore: whether to train each model with gensim's LdaMulticore
+		:param workers: the number of LdaMulticore workers of each model
+		:param patience: stop trying larger numbers of topics once this many in a row
+		have not improved the coherence. None tries them all
+		:param coherence: the coherence measure models are compared by. 'c_v', or the
+		cheaper 'c_npmi' or 'u_mass'
+		:param coherenceSample: the fraction of the reviews c_v and c_npmi are scored
+		on. None scores on all of them
+		:param visualise: whether to prepare the pyLDAvis visualisation. If not, the
+		visualisation returned is None
 
 		:returns: a tuple of the best lda model and the visualisation
 		'''
@@ -107,86 +656,95 @@ class TopicModeling:
 		if x is None:
 
 			# if this dataframe has not been prepared, prepare it
-			if 'prepped' in self.df.columns:
-				x = self.df['prepped']
-			else:
+			if 'prepped' not in self.df.columns:
 				self.prepdf()
 
-		# Create Dictionary
-		self.id2word = gensim.corpora.Dictionary(x)
+			x = self.df['prepped']
+
+		with metrics.stage('dictionary', len(x)):
+			# Create Dictionary
+			self.id2word = gensim.corpora.Dictionary(x)
+
+			# Term Document Frequency
+			self.setCorpus(CompactCorpus.fromTexts(x, self.id2word))
+			self.corpus_matches_dictionary = True
 
-		# Term Document Frequency
-		self.corpus = [self.id2word.doc2bow(text) for text in x]
+		# The numbers of topics to try
+		candidates = [numTopics] if numTopics else list(range(*topicRange))
 
 		# These are to store the performance and the best model
 		max_coherence_score = 0
 		best_n_topics = -1
 		best_model = None
-
-		if numTopics:
-			lda_model = gensim.models.ldamodel.LdaModel(corpus=self.corpus,
-													   id2word=self.id2word,
-													   num_topics=numTopics, 
-													   random_state=100,
-													   update_every=1,
-													   chunksize=100,
-													   passes=10,
-													   alpha='auto',
-													   per_word_topics=True)
-			
-			# Calculate Coherence Score
-			coherence_model_lda = gensim.models.CoherenceModel(model=lda_model,
-					texts=x, dictionary=self.id2word, coherence='c_v')
-			coherence_lda = coherence_model_lda.get_coherence()
-			
-			max_coherence_score = coherence_lda
-			best_n_topics = numTopics
-			best_model = lda_model
-			
-			# Print progress
-			print('\n The Coherence Score with {} topics is {}'.format(numTopics,coherence_lda))
-			
-		else:
-		
-			# Loop through each topic number and check if it has improved the performance
-			for i in range(2,6): 
-				# Build LDA model
-				lda_model = gensim.models.ldamodel.LdaModel(corpus=self.corpus,
-														   id2word=self.id2word,
-														   num_topics=i, 
-														   random_state=100,
-														   update_every=1,
-														   chunksize=100,
-														   passes=10,
-														   alpha='auto',
-														   per_word_topics=True)
-				
-				# Calculate Coherence Score
-				coherence_model_lda = gensim.models.CoherenceModel(model=lda_model,
-						texts=x, dictionary=self.id2word, coherence='c_v')
-				coherence_lda = coherence_model_lda.get_coherence()
-
-				# If this has the best coherence score so far, save it
-				if max_coherence_score < coherence_lda:
-					max_coherence_score = coherence_lda
-					best_n_topics = i
-					best_model = lda_model
-
-				# Print progress
-				print('\n The Coherence Score with {} topics is {}'.format(i,coherence_lda))
+		since_best = 0
+		self.coherence_scores = {}
+
+		texts = list(x)
+		if coherenceSample and coherence != 'u_mass':
+			texts = [texts[i] for i in sorted(np.random.RandomState(100).choice(
+				len(texts), max(1, int(len(texts)*coherenceSample)), replace=False))]
+
+		index = coherenceIndex(texts, self.id2word, coherence, len(candidates))
+
+		processes = max(1, min(int(processes), len(candidates)))
+		executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+
+		try:
+			# Candidates are trained a wave at a time so the sweep can stop early
+			for start in range(0, len(candidates), processes):
+				wave = candidates[start:start + processes]
+				args = [(self.corpus, self.id2word, i, multicore, workers) for i in wave]
+
+				with metrics.stage('lda', len(wave)):
+					if executor is None:
+						models = [trainModel(*i) for i in args]
+					else:
+						models = list(executor.map(trainModel, *zip(*args)))
+
+				# Loop through each topic number and check if it has improved the performance
+				for i, lda_model in zip(wave, models):
+
+					# Calculate Coherence Score
+					with metrics.stage('coherence', 1):
+						coherence_lda = scoreModel(lda_model, texts, self.id2word, coherence, index, self.corpus)
+					self.coherence_scores[i] = coherence_lda
+
+					# If this has the best coherence score so far, save it
+					if best_model is None or max_coherence_score < coherence_lda:
+						max_coherence_score = coherence_lda
+						best_n_topics = i
+						best_model = lda_model
+						since_best = 0
+					else:
+						since_best += 1
+
+					# Print progress
+					print('\n The Coherence Score with {} topics is {}'.format(i,coherence_lda))
+
+				if patience is not None and since_best >= patience:
+					print('\n Coherence has not improved for {} models, keeping {} topics'.format(since_best, best_n_topics))
+					break
+		finally:
+			if executor is not None:
+				executor.shutdown()
 
 		# Visualize the topics
 		#pyLDAvis.enable_notebook()
-		vis = pyLDAvis.gensim.prepare(best_model, self.corpus, self.id2word)
+		vis = None
+		if visualise:
+			with metrics.stage('visualise', len(self.corpus)):
+				vis = pyLDAvisGensim().prepare(best_model, self.corpus, self.id2word)
 
 		return best_model, vis
 
-	def ldaFromReviews(self):
+	def ldaFromReviews(self, numTopics = 3, **kwargs):
 		'''
 		A method to run the LDA model on the reviews dataframe. If the dataframe
 		has been prepared for the LDA already, the model is directly run. Otherwise
 		the dataframe is prepared first. The resulting model and visualisation is
 		attached to this object.
+		:param numTopics: the number of topics. None chooses it automatically
+		:param kwargs: further arguments of ldaModel
 		'''
 
 		# If the dataframe hasn't yet been prepped, prep it
@@ -194,49 +752,194 @@ class TopicModeling:
 			self.prepdf()
 
 		# Save the model and the visualisation to this object    
-		self.ldamodel,self.ldavis = self.ldaModel(numTopics = 3)
+		self.ldamodel,self.ldavis = self.ldaModel(numTopics = numTopics, **kwargs)
 
-	def generate_wordcloud_from_freq(self): 
+	def foldIn(self, ldamodel, id2word, bigrams, corpus, visualise = True):
+		'''
+		This method updates a previously trained model with the reviews attached to
+		this object instead of training a new one. The bigrams learn from the new
+		reviews, but the dictionary is kept since the model cannot learn new words.
+		The updated model and its visualisation are attached to this object.
+		:param ldamodel: the trained LDA model
+		:param id2word: the dictionary the model was trained with
+		:param bigrams: the Phrases model the reviews were prepped with. A frozen model,
+		such as the shared model of a domain, is used as it is
+		:param corpus: the bag of words corpus the model was trained on
+		:param visualise: whether to prepare the pyLDAvis visualisation
+		'''
+
+		if 'cleaned' in self.df.columns:
+			cleaned = self.df['cleaned']
+		else:
+			cleaned = [self.cleanDocument(i) for i in self.df[self.review_column]]
+
+		if hasattr(bigrams, 'add_vocab'):
+			bigrams.add_vocab(cleaned)
+		bigrams_Phrases = freezePhrases(bigrams)
+
+		self.df['prepped'] = [bigrams_Phrases[i] for i in cleaned]
+		if 'cleaned' in self.df.columns:
+			del self.df['cleaned']
+
+		new_corpus = [id2word.doc2bow(text) for text in self.df['prepped']]
+
+		# Online update with the new reviews only
+		if new_corpus:
+			with metrics.stage('lda_update', len(new_corpus)):
+				ldamodel.update(new_corpus)
+
+		self.bigrams = bigrams
+		self.id2word = id2word
+		self.setCorpus(CompactCorpus.fromBow(itertools.chain(corpus, new_corpus)))
+		self.corpus_matches_dictionary = False
+		self.ldamodel = ldamodel
+		self.ldavis = None
+		if visualise:
+			with metrics.stage('visualise', len(self.corpus)):
+				self.ldavis = pyLDAvisGensim().prepare(ldamodel, self.corpus, id2word)
+
+	def setCorpus(self, corpus):
+		'''
+		This method attaches a corpus to this object, memory-mapped from corpus_dir
+		if one was given
+		:param corpus: a CompactCorpus
+		'''
+
+		self.corpus = corpus.mmap(self.corpus_dir) if self.corpus_dir else corpus
+
+	def releaseReviews(self):
+		'''
+		This method drops the reviews attached to this object once the model has been
+		built from them. The model, dictionary and corpus are kept, so the word cloud,
+		summary and visualisation can still be made.
+		'''
+
+		self.df = pd.DataFrame(columns=[self.review_column])
+
+	def termFrequencies(self):
+		'''
+		This method returns the number of times each word occurs in the corpus, as an
+		array indexed by word id. When the dictionary was built from the same texts as
+		the corpus, its collection frequencies are used directly. Otherwise the counts
+		of each word id are summed over the corpus.
+		'''
+
+		num_terms = len(self.id2word)
+		cfs = getattr(self.id2word, 'cfs', None)
+
+		if self.corpus_matches_dictionary and cfs:
+			frequencies = np.zeros(num_terms)
+			frequencies[np.fromiter(cfs.keys(), dtype=np.int64, count=len(cfs))] = \
+				np.fromiter(cfs.values(), dtype=np.float64, count=len(cfs))
+			return frequencies
+
+		if isinstance(self.corpus, CompactCorpus):
+			return self.corpus.termFrequencies(num_terms)
+
+		matrix = gensim.matutils.corpus2csc(self.corpus, num_terms=num_terms)
+
+		return np.asarray(matrix.sum(axis=1)).ravel()
+
+	def topicShares(self, chunksize = 1000):
+		'''
+		This method returns the share of each topic in each document of the corpus,
+		inferring the documents a chunk at a time
+		:param chunksize: the number of documents inferred at a time
+		:returns: an array with a row for each document and a column for each topic
+		'''
+
+		shares = np.zeros((len(self.corpus), self.ldamodel.num_topics))
+
+		for start in range(0, len(self.corpus), chunksize):
+			gamma, _ = self.ldamodel.inference(self.corpus[start:start + chunksize])
+			shares[start:start + len(gamma)] = gamma / gamma.sum(axis=1, keepdims=True)
+
+		return shares
+
+	def topicSummary(self, topn = 10, shares = None):
+		'''
+		This method summarises the model as the top terms and overall weight of each
+		topic
+		:param topn: the number of terms listed for each topic
+		:param shares: the result of topicShares, if already inferred
+		:returns: a json serialisable dictionary
+		'''
+
+		if shares is None:
+			shares = self.topicShares()
+		weights = shares.mean(axis=0) if len(shares) else np.zeros(self.ldamodel.num_topics)
+
+		topics = [{'id': topic,
+				   'weight': float(weights[topic]),
+				   'terms': [{'term': term, 'weight': float(weight)}
+							 for term, weight in self.ldamodel.show_topic(topic, topn)]}
+				  for topic in range(self.ldamodel.num_topics)]
+
+		return {'num_topics': self.ldamodel.num_topics,
+				'num_documents': len(shares),
+				'topics': topics}
+
+	def generate_wordcloud_from_freq(self, frequencies = None, width = 400, height = 200, max_words = 200):
 		"""
 		A method to create a wordcloud according to the text frequencies
 		attached to this object. Takes into account the stopwords variable
-		of this object.
+		of this object. Word clouds are remembered, so the same frequencies
+		and size are only rendered once.
+		:param frequencies: an array of the frequency of each word id. Defaults to
+		the frequencies attached to this object
+		:param width: the width of the word cloud in pixels
+		:param height: the height of the word cloud in pixels
+		:param max_words: the most words shown
 		"""
-		
+
+		if frequencies is None:
+			frequencies = self.frequencies
+
+		# Only the most frequent words can be shown
+		top = np.argsort(frequencies)[::-1][:max_words]
+		frequency_dict = {self.id2word[int(i)]: float(frequencies[i]) for i in top if frequencies[i] > 0}
+
+		key = (hashlib.sha1(repr(sorted(frequency_dict.items())).encode('utf-8')).hexdigest(),
+			   width, height, max_words)
+		if key in _wordclouds:
+			_wordclouds.move_to_end(key)
+			return _wordclouds[key]
+
+		from wordcloud import WordCloud
+
 		wordcloud = WordCloud(background_color = 'white',
 							  relative_scaling = 1.0,
-							  stopwords = self.stopwords
-							  ).generate_from_frequencies(self.frequency_dict)
+							  stopwords = self.stopwords,
+							  width = width,
+							  height = height,
+							  max_words = max_words
+							  ).generate_from_frequencies(frequency_dict)
+
+		_wordclouds[key] = wordcloud
+		while len(_wordclouds) > WORDCLOUD_CACHE_SIZE:
+			_wordclouds.popitem(last=False)
 
 		return wordcloud
 
-	def generate_wordcloud(self):
+	def generate_wordcloud(self, width = 400, height = 200, max_words = 200):
 		'''
-		This method gets the frequency dictionary from the corpus that
-		has already been formed and creates a wordcloud. The corpus is
-		an id-frequency list for each document. The resulting frequency
-		dictionary is an id-frequency list for the entire corpus.
+		This method gets the frequency of each word from the corpus that
+		has already been formed and creates a wordcloud.
+		:param width: the width of the word cloud in pixels
+		:param height: the height of the word cloud in pixels
+		:param max_words: the most words shown
 		'''
 
 		# If there isn't a corpus, run lda
 		if self.corpus is None:
 			self.ldaFromReviews()
 
-		# Get a frequncy list or tuples for each document in the corpus
-		self.freq_list = []
-		[self.freq_list.extend(i) for i in self.corpus[:]]
-
-		# Now create a single dictionary with id-frequency key value pairs for all docs
-		self.frequency_dict = dict()
-		for i,j in self.freq_list:
-			key = self.id2word[i]
-			if key in self.frequency_dict:
-				self.frequency_dict[key] += j
-			else:
-				self.frequency_dict[key] = j
+		with metrics.stage('wordcloud', len(self.corpus)):
+			# The frequency of each word id over the entire corpus
+			self.frequencies = self.termFrequencies()
 
-		# Save wordcloud to the object        
-		self.wordCloud = self.generate_wordcloud_from_freq()
+			# Save wordcloud to the object        
+			self.wordCloud = self.generate_wordcloud_from_freq(self.frequencies, width, height, max_words)
 
 	def showWordCloud(self):
 		'''
@@ -245,8 +948,37 @@ class TopicModeling:
 		return self.wordCloud.to_image()
 		
 	def saveLDA(self, output='LDA.html'):
+		import pyLDAvis
+
+		# Prepare the visualisation if the model was run without it
+		if self.ldavis is None:
+			with metrics.stage('visualise', len(self.corpus)):
+				self.ldavis = pyLDAvisGensim().prepare(self.ldamodel, self.corpus, self.id2word)
+
 		pyLDAvis.save_html(self.ldavis,output)
 
+	def saveSummary(self, output='LDA.json', topn = 10, shares = None):
+		with metrics.stage('summary', len(self.corpus)):
+			summary = self.topicSummary(topn, shares)
+
+		with open(output, 'w') as f:
+			json.dump(summary, f)
+
+	def saveDocumentTopics(self, output='LDAdocs.json', shares = None):
+		'''
+		This method writes the share of each topic in each review. They are kept apart
+		from the summary, which is read on every view of the result.
+		:param output: the path to write to
+		:param shares: the result of topicShares, if already inferred
+		'''
+
+		if shares is None:
+			with metrics.stage('summary', len(self.corpus)):
+				shares = self.topicShares()
+
+		with open(output, 'w') as f:
+			json.dump({'num_topics': self.ldamodel.num_topics, 'documents': np.round(shares, 4).tolist()}, f)
+
 	def saveWordcloud(self, output='WC.png'):
 		self.wordCloud.to_image().save(output)
 	
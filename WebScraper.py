@@ -1,9 +1,307 @@
-from lxml import html
+from lxml import etree, html
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from PageCache import CacheMiss
+import metrics
+import multiprocessing
 import requests
 import pandas as pd
+import hashlib
+import random
+import re
+import threading
 import time
 
 
+# The rating for each tripadvisor bubble class number and yelp star label
+STAR_RATINGS = {'5': 0.5, '10': 1, '15': 1.5, '20': 2, '25': 2.5,
+                '30': 3, '35': 3.5, '40': 4, '45': 4.5, '50': 5,
+                '0.5': 0.5, '1.0': 1, '1.5': 1.5, '2.0': 2, '2.5': 2.5,
+                '3.0': 3, '3.5': 3.5, '4.0': 4, '4.5': 4.5, '5.0': 5}
+
+# e.g. class="ui_bubble_rating bubble_45" and title="4.5 star rating"
+TRIPADVISOR_STARS = re.compile(r'\bbubble_(\d+)\b')
+YELP_STARS = re.compile(r'(\d\.\d) star')
+
+
+def hasClass(name):
+    '''
+    This function returns an xpath condition matching elements with a class,
+    the same way as lxml's find_class
+    name: the class name
+    '''
+
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+
+# The selectors are compiled once and reused for every page
+TRIPADVISOR_CONTAINERS = etree.XPath('//*[{}]'.format(hasClass('review-container')))
+TRIPADVISOR_REVIEW = etree.XPath('.//*[{}]'.format(hasClass('entry')))
+TRIPADVISOR_TITLE = etree.XPath('.//*[{}]'.format(hasClass('noQuotes')))
+TRIPADVISOR_DATE = etree.XPath('.//*[{}]'.format(hasClass('ratingDate')))
+TRIPADVISOR_RATING = etree.XPath(".//*[contains(@class, 'bubble_')]/@class")
+
+YELP_CONTAINERS = etree.XPath('//*[{}]'.format(hasClass('review-content')))
+YELP_REVIEW = etree.XPath('p')
+YELP_RATING = etree.XPath('.//*[{}]'.format(hasClass('biz-rating')))
+YELP_RATING_LABEL = etree.XPath("descendant-or-self::*/@*[name()='title' or name()='alt' or name()='aria-label']")
+YELP_DATE = etree.XPath('.//*[{}]'.format(hasClass('rating-qualifier')))
+
+
+def tripadvisorRows(top):
+    '''
+    This function extracts the review components from a tripadvisor page in a
+    single pass over the review containers
+    top: the html object of the page
+    returns: a tuple of the number of review containers and a list of
+    (review, title, rating, date) rows
+    '''
+
+    containers = TRIPADVISOR_CONTAINERS(top)
+    rows = []
+
+    for i in containers:
+        review = TRIPADVISOR_REVIEW(i)
+        title = TRIPADVISOR_TITLE(i)
+        date = TRIPADVISOR_DATE(i)
+
+        # Containers missing a component are left out, failing the diagnostics
+        if not (review and title and date):
+            continue
+
+        # The class name of the bubble element determines the rating
+        rating = 0
+        for class_name in TRIPADVISOR_RATING(i):
+            match = TRIPADVISOR_STARS.search(class_name)
+            if match:
+                rating = STAR_RATINGS.get(match.group(1), 0)
+                break
+
+        # Plain strings, which do not keep the page alive and can be sent between processes
+        rows.append((str(review[0].text_content()), str(title[0].text_content()), rating,
+                     str(date[0].text_content())))
+
+    return len(containers), rows
+
+
+def yelpRows(top):
+    '''
+    This function extracts the review components from a yelp page in a
+    single pass over the review contents. Yelp reviews have no titles, so the
+    title of each row is empty.
+    top: the html object of the page
+    returns: a tuple of the number of review contents and a list of
+    (review, title, rating, date) rows
+    '''
+
+    containers = YELP_CONTAINERS(top)
+    rows = []
+
+    for i in containers:
+        review = YELP_REVIEW(i)
+        rating_element = YELP_RATING(i)
+        date = YELP_DATE(i)
+
+        # Containers missing a component are left out, failing the diagnostics
+        if not (review and rating_element and date):
+            continue
+
+        # The star label of the biz-rating element determines the rating
+        rating = 0
+        for label in YELP_RATING_LABEL(rating_element[0]):
+            match = YELP_STARS.search(label)
+            if match:
+                rating = STAR_RATINGS.get(match.group(1), 0)
+                break
+
+        # When a review is updated, the word updated review is present in the dates string
+        rows.append((str(review[0].text_content()), '', rating,
+                     str(date[0].text_content()).replace('Updated review','').strip()))
+
+    return len(containers), rows
+
+
+# The function extracting the review components of each supported site
+SITE_ROWS = {'tripadvisor': tripadvisorRows, 'yelp': yelpRows}
+
+
+def parsePage(site, content):
+    '''
+    This function extracts the review components from the content of a page. It is
+    a module function so that it can be run in a parsing process.
+    site: the site the page is on, in lower case
+    content: bytes. The content of the page
+    returns: a tuple of the number of review containers and a list of
+    (review, title, rating, date) rows
+    raises: ValueError if the page is empty or cannot be parsed
+    '''
+
+    # lxml errors keep an error log that cannot be sent back from a parsing process
+    try:
+        top = html.fromstring(content)
+    except (etree.ParserError, etree.ParseError) as e:
+        raise ValueError('Unparsable page: {}'.format(e)) from None
+
+    return SITE_ROWS[site](top)
+
+
+def createParsePool(processes):
+    '''
+    This function creates a pool of processes to parse pages in. The processes are
+    started from a forkserver, or spawned where there is none, so they are never
+    forked from a process whose fetching threads may hold locks.
+    processes: the number of processes
+    '''
+
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(method))
+
+
+def reviewHash(text):
+    '''
+    This function returns the hash a review is recognised by, the same as
+    ModelStore.reviewHash
+    text: the text of the review
+    '''
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def createSession(pool_size = 10):
+    '''
+    This function creates a requests session that keeps connections to each host
+    alive and reuses them for later requests.
+    pool_size: the number of connections kept open to each host
+    returns: requests.Session
+    '''
+
+    session = requests.Session()
+
+    # Retries are done by the scraper, so the adapter itself never retries
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class RateLimiter:
+    """
+    A token bucket rate limiter that is kept separately for each host. Every
+    request takes a token from the bucket of its host, and tokens are refilled
+    at a fixed rate up to the size of the bucket. Calls to wait block until a
+    token is available, so any number of threads can share one limiter.
+    """
+
+    def __init__(self, rate = 1.0, burst = 1):
+        """
+        Constructor.
+        rate: the number of requests per second allowed for each host. A rate
+        of 0 or None disables limiting
+        burst: the number of requests that may be made back to back before
+        the rate applies
+        """
+
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.lock = threading.Lock()
+
+        # host -> (tokens available, time of the last refill)
+        self.buckets = {}
+
+    def wait(self, url):
+        '''
+        This function blocks until a request to the host of the url is allowed
+        url: A string url
+        '''
+
+        if not self.rate:
+            return
+
+        host = urlparse(url).netloc
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens, last = self.buckets.get(host, (self.burst, now))
+
+                # Refill the bucket according to the time passed since the last refill
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+                if tokens >= 1:
+                    self.buckets[host] = (tokens - 1, now)
+                    return
+
+                self.buckets[host] = (tokens, now)
+                delay = (1 - tokens) / self.rate
+
+            # Sleep outside the lock so that other hosts are not held up
+            time.sleep(delay)
+
+
+class PageWindow:
+    """
+    The pages of a scraper that are being fetched ahead of its caller. Up to
+    a window of pages are submitted to the executor at a time, and a new page
+    is submitted each time the caller takes one, so the window stays full.
+    """
+
+    def __init__(self, scraper, executor, prefetch = None):
+        """
+        Constructor.
+        scraper: the WebScraper the pages belong to
+        executor: the executor the pages are fetched on
+        prefetch: the most pages fetched ahead of the caller. Defaults to twice
+        the workers of the scraper
+        """
+
+        self.scraper = scraper
+        self.executor = executor
+        self.window = max(1, prefetch or 2*scraper.workers)
+        self.pages = iter(range(scraper.total_pages))
+        self.futures = deque()
+
+        self.fill()
+
+    def fill(self):
+        '''
+        This function submits pages until the window is full or no pages are left
+        '''
+
+        while len(self.futures) < self.window:
+            page = next(self.pages, None)
+            if page is None:
+                break
+            self.futures.append(self.scraper.readPage(self.executor, self.scraper.pageUrl(page), page))
+
+        metrics.observe('fetch_queue', sum(not i.done() for i in self.futures))
+
+    def next(self):
+        '''
+        This function waits for the next page in page order and keeps the window full
+        returns: the reviews dataframe of the page, or None if it could not be read
+        '''
+
+        df = self.futures.popleft().result()
+
+        # Pages read ahead of the caller show whether the caller or the fetching holds things up
+        metrics.observe('pages_ahead', sum(i.done() for i in self.futures))
+        self.fill()
+
+        return df
+
+    def cancel(self):
+        '''
+        This function cancels the pages that have not started
+        '''
+
+        for future in self.futures:
+            future.cancel()
+
+
 class WebScraper:
     """
     This class aids in retrieving review information such as the review,
@@ -13,7 +311,11 @@ class WebScraper:
     """
 
     def __init__(self, url = '', site = '', silent = True, url1 = '', url2 = '', increment_string1 = '',
-                 increment_string2 = '',total_pages = 1, increment=10, seconds_wait = 1):
+                 increment_string2 = '',total_pages = 1, increment=10, seconds_wait = 1,
+                 workers = 1, rate_limit = None, burst = 1, rate_limiter = None, session = None,
+                 timeout = (10, 30), max_attempts = 5, backoff = 1, max_backoff = 30, cache = None,
+                 progress = None, executor = None, dedupe = True, parsers = 0, parse_pool = None,
+                 parse_queue = None):
         """
         Constructor.
         url: the main url of the website to scrape for one-off webscraping
@@ -25,7 +327,33 @@ class WebScraper:
         increment_string2: the second incremental part of the url
         total_pages: total number of pages to increment
         increment: the amount each page should increment each time
-        seconds_wait: wait time between requests
+        seconds_wait: wait time between requests to the same host. Only used when
+        rate_limit is not given
+        workers: the number of pages to fetch concurrently
+        rate_limit: the maximum number of requests per second to each host
+        burst: the number of requests to a host that may be made back to back
+        rate_limiter: a RateLimiter to share between several scrapers. If not
+        given, one is created from rate_limit and burst
+        session: a requests session to share between several scrapers. If not
+        given, one is created with a connection pool for the workers
+        timeout: the connect and read timeouts of a request in seconds
+        max_attempts: the number of times a page is read before it is given up on
+        backoff: the base wait in seconds before a page is re-read. This doubles
+        after every failed read
+        max_backoff: the longest wait in seconds before a page is re-read
+        cache: a PageCache to serve pages from. Stale pages are revalidated with
+        the site, and an offline cache never touches the network
+        progress: a function called with the stage name and the number of pages
+        read and to read after every page
+        executor: a thread pool to share between several scrapers. If not given,
+        one with the workers of this object is created for each series of pages
+        dedupe: drop reviews already read from an earlier page of the series. Reviews
+        move to the next page when new ones are posted while the pages are read
+        parsers: the number of processes pages are parsed in while the workers fetch
+        further pages. 0 parses pages in the fetching threads
+        parse_pool: a pool from createParsePool to share between several scrapers
+        parse_queue: the most pages waiting for or in the parsing processes. Workers
+        with further pages wait for room. Defaults to twice the parsing processes
 
         Remark: url1, url2 are the static parts of the urls that do not change in incrementation
 
@@ -52,6 +380,39 @@ class WebScraper:
         self.site = site
         self.seconds_wait = seconds_wait
         self.silent = silent
+        self.workers = max(1, int(workers))
+
+        # The politeness limit replaces a fixed sleep after every request
+        if rate_limit is None:
+            rate_limit = 1.0 / seconds_wait if seconds_wait else None
+
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(rate_limit, burst)
+
+        self.rate_limiter = rate_limiter
+
+        if session is None:
+            session = createSession(self.workers)
+
+        self.session = session
+        self.timeout = timeout
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache = cache
+        self.progress = progress
+        self.executor = executor
+        self.dedupe = dedupe
+        self.parsers = max(0, int(parsers))
+        self.parse_pool = parse_pool
+        self.parse_slots = threading.BoundedSemaphore(parse_queue or 2*max(1, self.parsers))
+
+        # The pages that could not be read within max_attempts
+        self.failed_pages = []
+
+        # The hashes of the reviews read from the series of pages, and the number of repeats dropped
+        self.seen = set()
+        self.duplicates = 0
 
         self.supported_sites = ['tripadvisor','yelp']
 
@@ -63,53 +424,13 @@ class WebScraper:
         """
 
         if self.site.lower() == 'tripadvisor':
-            x2 = str(x).replace('>', ' ').split()
-            if ('bubble_5"' in x2):
-                return 0.5
-            elif ('bubble_10"' in x2):
-                return 1
-            elif ('bubble_15"' in x2):
-                return 1.5
-            elif ('bubble_20"' in x2):
-                return 2
-            elif ('bubble_25"' in x2):
-                return 2.5
-            elif ('bubble_30"' in x2):
-                return 3
-            elif ('bubble_35"' in x2):
-                return 3.5
-            elif ('bubble_40"' in x2):
-                return 4
-            elif ('bubble_45"' in x2):
-                return 4.5
-            elif ('bubble_50"' in x2):
-                return 5
-            else:
-                return 0
+            match = TRIPADVISOR_STARS.search(str(x))
         elif self.site.lower() == 'yelp':
-            x2 = str(x)
-            if ('0.5 star' in x2):
-                return 0.5
-            elif ('1.0 star' in x2):
-                return 1
-            elif ('1.5 star' in x2):
-                return 1.5
-            elif ('2.0 star' in x2):
-                return 2
-            elif ('2.5 star' in x2):
-                return 2.5
-            elif ('3.0 star' in x2):
-                return 3
-            elif ('3.5 star' in x2):
-                return 3.5
-            elif ('4.0 star' in x2):
-                return 4
-            elif ('4.5 star' in x2):
-                return 4.5
-            elif ('5.0 star' in x2):
-                return 5
-            else:
-                return 0
+            match = YELP_STARS.search(str(x))
+        else:
+            return None
+
+        return STAR_RATINGS.get(match.group(1), 0) if match else 0
 
     def diagnostics(self,*args):
         '''
@@ -140,6 +461,66 @@ class WebScraper:
         return True
 
 
+    def fetch(self, url):
+        '''
+        This function gets the content of a url through the session of this object.
+        If this object has a cache, fresh pages are served from it and stale pages
+        are revalidated with a conditional request.
+        url: A string url
+        returns: bytes. The content of the page
+        '''
+
+        entry = None
+
+        if self.cache is not None:
+            entry = self.cache.get(url)
+
+            if entry is not None and self.cache.isFresh(entry):
+                metrics.count('page_cache_hits')
+                return entry['content']
+
+            if self.cache.offline:
+                raise CacheMiss(url)
+
+        # Only requests that reach the site count towards the politeness limit
+        self.rate_limiter.wait(url)
+
+        headers = self.cache.validators(entry) if self.cache is not None else {}
+        with metrics.depth('fetching'), metrics.stage('fetch', 1):
+            page = self.session.get(url, timeout=self.timeout, headers=headers)
+
+        # The stored page is still current
+        if page.status_code == 304 and entry is not None:
+            metrics.count('page_cache_revalidations')
+            self.cache.refresh(url, entry)
+            return entry['content']
+
+        # Treat error status codes as failed reads
+        page.raise_for_status()
+        metrics.count('bytes_fetched', len(page.content))
+
+        if self.cache is not None:
+            self.cache.put(url, page.content, page.headers)
+
+        return page.content
+
+    def parse(self, content):
+        '''
+        This function extracts the review components from the content of a page. With
+        a parsing pool, the page is parsed in one of its processes and this function
+        waits for it. Pages read by a PageWindow are handed to the pool without
+        waiting, by readPage.
+        content: bytes. The content of the page
+        returns: a tuple of the number of review containers and a list of
+        (review, title, rating, date) rows
+        '''
+
+        if self.parse_pool is None:
+            return parsePage(self.site.lower(), content)
+
+        with metrics.depth('parse_queue'), self.parse_slots:
+            return self.parse_pool.submit(parsePage, self.site.lower(), content).result()
+
     def scrape(self,url = ''):
         '''
         This functioni scrapes relevant review tags from a website url. If a url
@@ -149,101 +530,54 @@ class WebScraper:
         site: A string indicating the site name to be scraped
         silent: A boolean indicating whether diagnostic results are to be displayed
         '''
-        
-        # A variable to store the success of the read
-        success = False
 
         # If a main url is not provided, get it from the object
         if not url:
             url = self.url
 
-        # These are to store the actual review components
-        reviews_array = []
-        ratings_array = []
-        titles_array = []
-        dates_array=[]
-        
-        # Get the request object from the server
-        page = requests.get(url)
-        
-        # Convert the request content to an html object
-        top = html.fromstring(page.content)
-
         # Site specific html configuration
-        if self.site.lower() == 'tripadvisor':
-            
-            # Get all the review containers
-            reviews = top.find_class('review-container')
-            
-            # Loop through the review containers and get the actual reviews    
-            for i in reviews:
-                reviews_array.append((i.find_class('entry')[0]).text_content())
-
-            # Within each review container is a class, the name of 
-            # which determines the rating to display
-            # We use the findStars function to determine the rating 
-            # from the class name
-            for i in reviews:
-                ratings_array.append(self.findStars(html.tostring(i)))
-
-            # Get the titles from each review container
-            for i in reviews:
-                titles_array.append(i.find_class('noQuotes')[0].text_content())
-            
-            # Get the dates from each review container
-            for i in reviews:
-                dates_array.append(i.find_class('ratingDate')[0].text_content())
-                
-            # Diagnostics
-            success = self.diagnostics(ratings_array,reviews_array,dates_array,titles_array)
-            
-        elif self.site.lower() == 'yelp':
-            #rev_class_1 = 'review-content'
-            #rev_class_2 = 'p'
-            #rat_class = 'biz-rating'
-            #dat_class_2 = 'rating-qualifier'
-            
-            # Get all the review contents
-            reviews = top.find_class('review-content')
-            
-            # Loop through the review contents and get the actual reviews                
-            for i in reviews:
-                reviews_array.append(i.find('p').text_content())
-            
-            # Set empty the titles. i.e. there are no titles for yelp
-            titles_array = reviews_array.copy()
-            
-            # Within each review-content is a class called biz-rating, the name of 
-            # which determines the rating to display
-            # We use the findStars function to determine the rating from the class name
-            for i in [getattr(i,'find_class')('biz-rating')[0] for i in reviews]:
-                ratings_array.append(self.findStars(html.tostring(i)))   
-            
-            # Get the dates. When a review is updated, the word updated review is present
-            # in the dates string
-            for i in reviews:
-                dates_array.append((i.find_class('rating-qualifier')[0].text_content()).\
-                                   replace('Updated review','').lstrip().rstrip())
-            
-            # Diagnostics
-            success = self.diagnostics(ratings_array,reviews_array,dates_array)
-            
-        else:
+        if self.site.lower() not in SITE_ROWS:
             print('The site {} is not supported'.format(self.site))
             return False
 
+        content = self.fetch(url)
+
+        try:
+            with metrics.stage('parse') as parse:
+                # Get the review, title, rating and date of every review
+                containers, rows = self.parse(content)
+                parse.items = len(rows)
+        except Exception:
+            self.discardPage(url)
+            raise
+
+        return self.pageReviews(url, containers, rows)
+
+    def pageReviews(self, url, containers, rows):
+        '''
+        This function turns the rows parsed from a page into its reviews dataframe,
+        checking that every component of every review was found. A page that fails,
+        e.g. a bot wall or a truncated page, is removed from the cache so that it is
+        read from the site again on retry.
+        url: A string url
+        containers: the number of review containers of the page
+        rows: a list of (review, title, rating, date) rows
+        returns: a tuple of the reviews dataframe and whether the page passed the diagnostics
+        '''
+
+        # Diagnostics
+        success = self.diagnostics(range(containers), rows)
+        if not success:
+            self.discardPage(url)
+
         # Convert to a dataframe
-        df_review = pd.DataFrame(reviews_array, columns=['Review'])
-        df_ratings = pd.DataFrame(ratings_array, columns=['Rating'])
-        df_titles = pd.DataFrame(titles_array, columns=['title'])
-        df_reviewdates = pd.DataFrame(dates_array, columns=['date'])
-        
-        # Consolidate into a single dataframe
-        df_fullreview = pd.concat([df_review,df_titles,df_ratings['Rating'], df_reviewdates],axis=1)
-        df_fullreview.dropna(inplace=True)
+        df_fullreview = pd.DataFrame(rows, columns=['Review', 'title', 'Rating', 'date'])
         
-        # Combine review and title into a single column
-        df_fullreview['fullreview'] = df_fullreview['Review'] + ' ' + df_fullreview['title']
+        # Combine review and title into a single column. Without titles, the review is used as it is
+        if self.site.lower() == 'yelp':
+            df_fullreview['fullreview'] = df_fullreview['Review']
+        else:
+            df_fullreview['fullreview'] = df_fullreview['Review'] + ' ' + df_fullreview['title']
 
         # Store the reviews to a member variable
         self.reviews = df_fullreview
@@ -251,69 +585,336 @@ class WebScraper:
         return df_fullreview,success
         
 
-    def fullscraper(self):
+    def discardPage(self, url):
         '''
-        This function increments the site url to the next page according to update 
-        criteria and scrapes that page. The full url of subsequent pages is 
-        url = url1 + increment_string1 + increment + increment_string2 + url2.
+        This function removes a page that could not be read from the cache. An
+        offline cache keeps it, since it is the only copy.
+        url: A string url
         '''
 
-        # A variable to store the success of the read
-        success = False
-        
-        # Main data frame
-        df = pd.DataFrame()
-        
+        if self.cache is not None and not self.cache.offline:
+            self.cache.discard(url)
+
+    def pageUrl(self, page):
+        '''
+        This function composes the url of a page. The first page has no increment.
+        page: the zero based index of the page
+        '''
+
+        if page == 0:
+            return self.first_url
+
+        return self.url1 + self.increment_string1 + str(page*self.increment) + self.increment_string2 + self.url2
+
+    def scrapeWithRetry(self, url, page = 0):
+        '''
+        This function scrapes a url, re-reading it until the read is successful or
+        self.max_attempts reads have failed. Failed reads back off exponentially
+        with jitter. Pages missing from an offline cache are not retried.
+        url: A string url
+        page: the zero based index of the page, used to report failures
+        returns: the reviews dataframe, or None if the page could not be read
+        '''
+
+        error = None
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                df,success = self.scrape(url)
+                if success:
+                    return df
+                error = 'Unequal number of review components'
+            except CacheMiss:
+                self.failed_pages.append({'page': page, 'url': url, 'attempts': attempt, 'error': 'Not in cache'})
+                return None
+            except (requests.RequestException, ValueError) as e:
+                # An empty or malformed page is a failed read, like a failed request
+                error = repr(e)
+
+            print('Error in reading page {} (attempt {}/{}): {}'.format(page + 1, attempt, self.max_attempts, error))
+
+            # Wait a random time of up to the backoff before re-reading
+            if attempt < self.max_attempts:
+                time.sleep(self.backoffWait(attempt))
+
+        # Record the failure instead of retrying forever
+        self.failed_pages.append({'page': page, 'url': url, 'attempts': self.max_attempts, 'error': error})
+
+        return None
+
+    def backoffWait(self, attempt):
+        '''
+        This function returns a random wait of up to the backoff after a failed read
+        attempt: the number of the failed attempt
+        '''
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def readPage(self, executor, url, page = 0):
+        '''
+        This function starts reading a page on a pool of fetching threads. Without a
+        parsing pool, a thread fetches and parses the page with scrapeWithRetry. With
+        one, the thread hands the page to the parsing pool and moves on to the next
+        page, and the parsed rows are turned into reviews by the next free thread.
+        Failed reads are retried in the same way as by scrapeWithRetry.
+        executor: the pool of fetching threads
+        url: A string url
+        page: the zero based index of the page, used to report failures
+        returns: a Future of the reviews dataframe, or of None if the page could not be read
+        '''
+
+        if self.parse_pool is None:
+            return executor.submit(self.scrapeWithRetry, url, page)
+
+        outcome = Future()
+        self.submitPage(executor, outcome, self.fetchToPool, executor, url, page, 1, outcome)
+
+        return outcome
+
+    def submitPage(self, executor, outcome, *args):
+        '''
+        This function runs a step of reading a page on the fetching threads. Once the
+        threads are shut down, e.g. because the caller stopped reading, the page is
+        given up.
+        executor: the pool of fetching threads
+        outcome: the Future of the page
+        args: the function to run and its arguments
+        '''
+
+        try:
+            executor.submit(*args)
+        except RuntimeError:
+            if not outcome.done():
+                outcome.set_result(None)
+
+    def fetchToPool(self, executor, url, page, attempt, outcome, wait = 0):
+        '''
+        This function fetches a page in a fetching thread and hands it to the parsing
+        pool. At most parse_queue pages wait for or are in the pool, so the fetching
+        pauses while the pool catches up.
+        attempt: the number of this attempt at reading the page
+        outcome: the Future of the page
+        wait: the number of seconds to wait first, after a failed attempt
+        The other arguments are those of readPage.
+        '''
+
+        # A page cancelled before it started is not fetched
+        if attempt == 1 and not outcome.set_running_or_notify_cancel():
+            return
+
+        time.sleep(wait)
+
+        try:
+            content = self.fetch(url)
+        except CacheMiss:
+            self.failed_pages.append({'page': page, 'url': url, 'attempts': attempt, 'error': 'Not in cache'})
+            outcome.set_result(None)
+            return
+        except requests.RequestException as e:
+            self.retryPage(executor, url, page, attempt, outcome, repr(e))
+            return
+        except BaseException as e:
+            outcome.set_exception(e)
+            return
+
+        self.parse_slots.acquire()
+        metrics.enter('parse_queue')
+        start = time.perf_counter()
+
+        try:
+            parsed = self.parse_pool.submit(parsePage, self.site.lower(), content)
+        except BaseException as e:
+            metrics.leave('parse_queue')
+            self.parse_slots.release()
+            outcome.set_exception(e)
+            return
+
+        parsed.add_done_callback(lambda f: self.parsedPage(executor, url, page, attempt, outcome, f, start))
+
+    def parsedPage(self, executor, url, page, attempt, outcome, parsed, start):
+        '''
+        This function is called by the parsing pool when a page has been parsed. It
+        runs in the thread collecting the results of the pool, so the page is
+        finished by a fetching thread.
+        parsed: the Future of the parsed page
+        start: the time the page was handed to the pool
+        The other arguments are those of fetchToPool.
+        '''
+
+        metrics.leave('parse_queue')
+        self.parse_slots.release()
+
+        self.submitPage(executor, outcome, self.finishPage, executor, url, page, attempt, outcome, parsed,
+                        time.perf_counter() - start)
+
+    def finishPage(self, executor, url, page, attempt, outcome, parsed, seconds):
+        '''
+        This function turns a parsed page into its reviews, or reads it again if it
+        could not be parsed or failed the diagnostics
+        seconds: the time the page waited for and was in the parsing pool
+        The other arguments are those of parsedPage.
+        '''
+
+        try:
+            try:
+                containers, rows = parsed.result()
+            except ValueError as e:
+                # An empty or malformed page is a failed read, like a failed request
+                self.discardPage(url)
+                self.retryPage(executor, url, page, attempt, outcome, repr(e))
+                return
+
+            metrics.timed('parse', seconds, len(rows))
+            df, success = self.pageReviews(url, containers, rows)
+        except BaseException as e:
+            outcome.set_exception(e)
+            return
+
+        if success:
+            outcome.set_result(df)
+        else:
+            self.retryPage(executor, url, page, attempt, outcome, 'Unequal number of review components')
+
+    def retryPage(self, executor, url, page, attempt, outcome, error):
+        '''
+        This function reads a page again after a failed attempt, or records it as
+        failed once max_attempts reads have failed
+        error: the error of the failed attempt
+        The other arguments are those of fetchToPool.
+        '''
+
+        print('Error in reading page {} (attempt {}/{}): {}'.format(page + 1, attempt, self.max_attempts, error))
+
+        if attempt >= self.max_attempts:
+            self.failed_pages.append({'page': page, 'url': url, 'attempts': self.max_attempts, 'error': error})
+            outcome.set_result(None)
+            return
+
+        self.submitPage(executor, outcome, self.fetchToPool, executor, url, page, attempt + 1, outcome,
+                        self.backoffWait(attempt))
+
+    def dropSeen(self, df):
+        '''
+        This function drops the reviews of a page that have already been read, from
+        this or an earlier page, and records the hashes of the others. The hashes are
+        kept in a 'hash' column.
+        df: the reviews dataframe of a page
+        '''
+
+        df['hash'] = df['fullreview'].map(reviewHash)
+
+        # The first of any repeats within the page is kept
+        repeated = df['hash'].duplicated() | df['hash'].isin(self.seen)
+        self.seen.update(df['hash'])
+
+        dropped = int(repeated.sum())
+        if dropped:
+            self.duplicates += dropped
+            metrics.count('duplicate_reviews', dropped)
+            df = df[~repeated].reset_index(drop=True)
+
+        return df
+
+    def startPages(self, prefetch = None):
+        '''
+        This function starts fetching the first pages of the series of urls on the
+        shared executor of this object, before the caller is ready for them. Scrapers
+        sharing an executor can all be started, so the pages of several listings are
+        fetched side by side and the executor works through them in turn.
+        prefetch: the most pages fetched ahead of the caller. Defaults to twice the workers
+        returns: a PageWindow to pass to iterpages
+        '''
+
+        if self.executor is None:
+            raise ValueError('startPages needs a shared executor')
+
+        self.failed_pages = []
+        self.seen = set()
+        self.duplicates = 0
+
+        return PageWindow(self, self.executor, prefetch)
+
+    def iterpages(self, prefetch = None, window = None):
+        '''
+        This function scrapes every page of the series of urls and yields the reviews
+        of each page, in page order, as soon as it is available. Up to self.workers
+        pages are fetched at the same time and pages keep being fetched while the
+        caller works on earlier ones.
+        prefetch: the most pages fetched ahead of the caller. Defaults to twice the workers
+        window: the pages already started by startPages, if any
+        '''
+
+        # url incrementation differs per website
+        if self.site.lower() not in self.supported_sites:
+            return
+
         # Progress output
         print('Getting reviews ' + str(0)+'/ '+str(self.total_pages))
-        
-        # url incrementation differs per website
-        if self.site.lower() in self.supported_sites:
-
-            # Keep trying to read the first page until the read is successful
-            while not success:
-
-                # read the first page
-                df,success = self.scrape(self.first_url)
-                if not success:
-                    print('Error in reading - Re-reading')
-                    
-                # Wait for 1 second
-                time.sleep(self.seconds_wait)
-                    
-            print('Getting reviews ' + str(1)+'/ '+str(self.total_pages))
-
-            # now loop through each page and read it
-            for i in range(1,self.total_pages):
-
-                # whenever there is an error in reading a page, we retry
-                success = False
-
-                # compose the url of this page
-                url_temp = self.url1 + self.increment_string1 + str(i*self.increment) + self.increment_string2 + self.url2
-
-                # try to read the page until the read is successful
-                while not success:
-                    df_temp,success = self.scrape(url_temp)
-                    if not success:
-                        print('Error in reading - Re-reading')
-                            
-                    # Wait for 1 second
-                    time.sleep(self.seconds_wait)
-                
-                # Build the dataframe
-                df = pd.concat([df,df_temp])
-                
+
+        # Without a shared parsing pool, one is kept for these pages only
+        parse_pool = None
+        if self.parsers and self.parse_pool is None:
+            parse_pool = self.parse_pool = createParsePool(self.parsers)
+
+        # Without a shared executor, one is kept for these pages only
+        executor = None
+        if window is None:
+            self.failed_pages = []
+            self.seen = set()
+            self.duplicates = 0
+            if self.executor is None:
+                executor = ThreadPoolExecutor(max_workers=self.workers)
+            window = PageWindow(self, executor or self.executor, prefetch)
+
+        try:
+            done = 0
+            while window.futures:
+                df_temp = window.next()
+
                 # Print progress
-                print('Getting reviews ' + str(i+1)+'/ '+str(self.total_pages))
+                done += 1
+                print('Getting reviews ' + str(done)+'/ '+str(self.total_pages))
+                if self.progress is not None:
+                    self.progress('scraping', done, self.total_pages)
+
+                if df_temp is not None:
+                    yield self.dropSeen(df_temp) if self.dedupe else df_temp
+
+            if self.duplicates:
+                print('Dropped {} repeated reviews'.format(self.duplicates))
+
+            if self.failed_pages:
+                print('Failed to read {} of {} pages: {}'.format(len(self.failed_pages), self.total_pages,
+                                                                 sorted(i['page'] + 1 for i in self.failed_pages)))
 
             print('Complete!!!')
 
+        finally:
+            # If the caller stops early, pages not yet started are not fetched
+            window.cancel()
+            if executor is not None:
+                executor.shutdown(wait=True)
+            if parse_pool is not None:
+                self.parse_pool = None
+                parse_pool.shutdown()
+
+    def fullscraper(self):
+        '''
+        This function increments the site url to the next page according to update 
+        criteria and scrapes that page. The full url of subsequent pages is 
+        url = url1 + increment_string1 + increment + increment_string2 + url2.
+        Up to self.workers pages are fetched at the same time and the pages are
+        reassembled in page order.
+        '''
+
+        # Build the dataframe with a single concatenation
+        frames = list(self.iterpages())
+        df = pd.concat(frames) if frames else pd.DataFrame()
+
         # Store the read information into a member variable
         self.all_reviews = df.reset_index().iloc[:,1:]
 
 
-
 if __name__ == '__main__':
     # Single Usage
     url = "https://www.tripadvisor.co.uk/Attraction_Review-g190384-d6755801-Reviews-The_House_of_Dionysus-Paphos_Paphos_District.html"
@@ -329,7 +930,7 @@ if __name__ == '__main__':
 
     ms = WebScraper(site='tripadvisor',url1=inurl1,
                           url2=inurl2,increment_string1="-or",increment_string2="",
-                          total_pages=20,increment=10,silent=False)
+                          total_pages=20,increment=10,silent=False,workers=4,rate_limit=2)
 
     ms.fullscraper()
     
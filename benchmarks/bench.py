@@ -0,0 +1,248 @@
+'''
+Offline benchmarks of the scraper parsing and topic modelling stages.
+
+The parsing benchmarks parse the pages in benchmarks/fixtures with
+WebScraper.scrape, without the network. The pages are made up, with the
+markup of the review listings of each site but not their reviews, so no
+reviews of real users are kept in the repository. The corpus benchmarks
+time each TopicModeling stage on synthetic review corpora of increasing
+size, taking the same paths as an analysis. The results are written as json and can be compared against a baseline, in
+which case the exit status is 1 if any stage has slowed down by more than
+the tolerance.
+
+Example Usage (from the repository root):
+python benchmarks/bench.py --sizes 1000 10000 --output bench.json
+python benchmarks/bench.py --sizes 1000 10000 --baseline bench.json --tolerance 0.2
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+sys.path.insert(0, ROOT)
+
+import WebScraper
+import TopicModeling
+
+# The stages of the corpus benchmarks, in the order they run
+STAGES = ['cleanDocument', 'createGrams', 'dictionary', 'lda', 'coherence', 'pyLDAvis', 'wordcloud']
+
+
+def timed(func, *args, **kwargs):
+    '''
+    This function runs a function and returns its result and run time in seconds
+    '''
+
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+
+def record(results, name, seconds, items):
+    results[name] = {'seconds': seconds, 'items': items,
+                     'items_per_second': items / seconds if seconds else None}
+    print('{:<40} {:>10.3f}s {:>12.0f} items/s'.format(name, seconds, items / seconds if seconds else 0))
+
+
+def benchParsing(results, repeat):
+    '''
+    This function times parsing the fixture page of each supported site
+    repeat: the number of times each page is parsed
+    '''
+
+    for site in ['tripadvisor', 'yelp']:
+        with open(os.path.join(FIXTURES, site + '.html'), 'rb') as f:
+            content = f.read()
+
+        ms = WebScraper.WebScraper(site=site)
+
+        # Serve the fixture page instead of fetching it
+        ms.fetch = lambda url: content
+
+        reviews = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            df, success = ms.scrape('fixture')
+            reviews += len(df)
+        seconds = time.perf_counter() - start
+
+        record(results, 'parse/{}/pages'.format(site), seconds, repeat)
+        record(results, 'parse/{}/reviews'.format(site), seconds, reviews)
+
+
+def syntheticWord(i):
+    '''
+    This function returns a distinct made up word for each number. The words are
+    alphabetic so the tokenizer keeps them whole.
+    '''
+
+    word = 'q'
+    while True:
+        word += chr(97 + i % 26)
+        i //= 26
+        if not i:
+            return word
+
+
+def syntheticReviews(size, num_topics = 5, vocabulary = 5000, seed = 100):
+    '''
+    This function generates reviews of words drawn from a few overlapping topics,
+    each with a Zipf distribution of words, so the corpus resembles real reviews
+    size: the number of reviews
+    '''
+
+    random = np.random.RandomState(seed)
+    words = np.array([syntheticWord(i) for i in range(vocabulary)])
+
+    # Each topic favours a different shuffle of the vocabulary
+    ranks = np.arange(1, vocabulary + 1) ** -1.1
+    topics = [random.permutation(ranks / ranks.sum()) for _ in range(num_topics)]
+
+    reviews = []
+    for _ in range(size):
+        topic = topics[random.randint(num_topics)]
+        length = random.randint(20, 120)
+        reviews.append(' '.join(words[random.choice(vocabulary, length, p=topic)]))
+
+    return reviews
+
+
+def benchCorpus(results, size, stages):
+    '''
+    This function times each TopicModeling stage on a synthetic corpus
+    size: the number of reviews
+    stages: the names of the stages to time. Earlier stages always run, since
+    later stages need their output
+    '''
+
+    reviews = syntheticReviews(size)
+    last = max(STAGES.index(i) for i in stages)
+    prefix = 'corpus/{}/'.format(size)
+
+    def run(stage, func, *args, **kwargs):
+        result, seconds = timed(func, *args, **kwargs)
+        if stage in stages:
+            record(results, prefix + stage, seconds, size)
+        return result
+
+    tm = TopicModeling.TopicModeling(pd.DataFrame({'fullreview': reviews}), copy=False)
+
+    cleaned = run('cleanDocument', lambda: [tm.cleanDocument(x) for x in reviews])
+    if last < STAGES.index('createGrams'):
+        return
+
+    prepped = run('createGrams', lambda: tm.createGrams(cleaned)[0])
+    if last < STAGES.index('dictionary'):
+        return
+
+    def dictionary():
+        id2word = TopicModeling.gensim.corpora.Dictionary(prepped)
+        return id2word, TopicModeling.CompactCorpus.fromTexts(prepped, id2word)
+
+    tm.id2word, tm.corpus = run('dictionary', dictionary)
+    tm.corpus_matches_dictionary = True
+    if last < STAGES.index('lda'):
+        return
+
+    tm.ldamodel = run('lda', TopicModeling.trainModel, tm.corpus, tm.id2word, 5)
+    if last < STAGES.index('coherence'):
+        return
+
+    # Scored as ldaModel scores the single candidate of an analysis with a set number of topics
+    def coherence():
+        index = TopicModeling.coherenceIndex(prepped, tm.id2word, 'c_v', 1)
+        return TopicModeling.scoreModel(tm.ldamodel, prepped, tm.id2word, 'c_v', index)
+
+    run('coherence', coherence)
+    if last < STAGES.index('pyLDAvis'):
+        return
+
+    run('pyLDAvis', lambda: TopicModeling.pyLDAvisGensim().prepare(tm.ldamodel, tm.corpus, tm.id2word))
+    if last < STAGES.index('wordcloud'):
+        return
+
+    # Clear remembered word clouds so the render is timed
+    TopicModeling._wordclouds.clear()
+    run('wordcloud', tm.generate_wordcloud)
+
+
+def compare(results, baseline, tolerance):
+    '''
+    This function compares the results with a baseline
+    tolerance: the fraction by which a benchmark may be slower than its baseline
+    returns: a list of the names of the benchmarks that regressed
+    '''
+
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        before = baseline[name]['seconds']
+        change = result['seconds'] / before - 1 if before else 0
+
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = 'REGRESSION'
+
+        print('{:<40} {:>10.3f}s -> {:>10.3f}s {:>+8.1%} {}'.format(name, before, result['seconds'], change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scraper parsing and topic modelling stages')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 10000, 100000],
+                        help='the numbers of reviews of the synthetic corpora')
+    parser.add_argument('--stages', nargs='*', default=STAGES, choices=STAGES,
+                        help='the topic modelling stages to time')
+    parser.add_argument('--parse-repeat', type=int, default=200,
+                        help='the number of times each saved page is parsed')
+    parser.add_argument('--skip-parsing', action='store_true', help='do not time parsing')
+    parser.add_argument('--output', help='the json file the results are written to')
+    parser.add_argument('--baseline', help='a json file of earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='the fraction by which a benchmark may be slower than its baseline')
+    args = parser.parse_args()
+
+    results = {}
+
+    if not args.skip_parsing:
+        benchParsing(results, args.parse_repeat)
+
+    for size in args.sizes:
+        benchCorpus(results, size, args.stages)
+
+    report = {'meta': {'time': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'cpus': os.cpu_count()},
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('{} benchmarks regressed by more than {:.0%}'.format(len(regressions), args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
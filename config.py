@@ -3,5 +3,54 @@ import os
 workers = int(os.environ.get('GUNICORN_PROCESSES', '3'))
 threads = int(os.environ.get('GUNICORN_THREADS', '1'))
 
+# Preloading imports the app once in the master before forking the workers,
+# so the workers share the warmed modules copy-on-write and start instantly
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+# Whether the app imports the modelling stack at startup instead of in the first job
+warm_imports = os.environ.get('WARM_IMPORTS', '1' if preload_app else '0') == '1'
+
+# Workers are restarted after this many requests, with a random extra of up to the
+# jitter so they do not all restart at once, returning the memory they have grown to.
+# 0 never restarts them
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '50'))
+
 forwarded_allow_ips = '*'
 secure_scheme_headers = { 'X-Forwarded-Proto': 'https' }
+
+# The number of processes each job parses pages in while it fetches further pages.
+# 0 parses pages in the fetching threads
+parse_processes = int(os.environ.get('PARSE_PROCESSES', '0'))
+
+# Background jobs run in a pool of processes in each web worker
+job_workers = int(os.environ.get('JOB_WORKERS', '1'))
+job_queue_size = int(os.environ.get('JOB_QUEUE_SIZE', '5'))
+job_dir = os.environ.get('JOB_DIR', 'jobs')
+
+# The status of a finished job is kept for this many seconds
+job_max_age = int(os.environ.get('JOB_MAX_AGE', str(7*24*60*60)))
+
+# Low memory mode runs each job in a new process that returns all of its memory when the job ends
+low_memory_jobs = os.environ.get('LOW_MEMORY_JOBS', '0') == '1'
+
+# The most memory, in megabytes, each process of a job may use. 0 leaves it unlimited
+job_memory_limit_mb = int(os.environ.get('JOB_MEMORY_LIMIT_MB', '0'))
+
+# Results are served to identical analyses for this many seconds
+result_ttl = int(os.environ.get('RESULT_TTL', str(24*60*60)))
+
+# The most listings a batch job may analyse
+batch_max_listings = int(os.environ.get('BATCH_MAX_LISTINGS', '50'))
+
+# The most reviews whose topics one request may infer
+inference_max_texts = int(os.environ.get('INFERENCE_MAX_TEXTS', '1000'))
+
+# Browsers may reuse artifacts for this many seconds before revalidating them
+artifact_cache_seconds = int(os.environ.get('ARTIFACT_CACHE_SECONDS', '3600'))
+
+# Listings share the bigram phrase model of this domain, unless a form names another
+phrase_domain = os.environ.get('PHRASE_DOMAIN', '')
+
+# Reviews at least this similar to an earlier review of the listing are dropped. 0 keeps them
+near_duplicates = float(os.environ.get('NEAR_DUPLICATES', '0'))
@@ -1,44 +1,572 @@
-import WebScraper
-import TopicModeling
-import string
-import random
+from ArtifactStore import ArtifactStore
+import ctypes
+import gc
+import hashlib
+import importlib
+import json
 import os
+import time
+
+# The scraping and modelling modules are slow to import, so they are only
+# imported when first needed. The time each import took, in seconds
+IMPORT_TIMES = {}
+
+# The modules warmup imports ahead of the first job
+MODELLING_MODULES = ['pandas', 'lxml.html', 'gensim', 'WebScraper', 'PageCache', 'CompactCorpus', 'TopicModeling',
+					 'ModelStore', 'pyLDAvis.gensim', 'wordcloud']
+
+
+def importModule(name):
+	'''
+	This function imports a module, recording how long the import took
+	name: the name of the module
+	'''
+
+	start = time.perf_counter()
+	module = importlib.import_module(name)
+	IMPORT_TIMES.setdefault(name, time.perf_counter() - start)
+
+	return module
+
+
+def warmup():
+	'''
+	This function imports the scraping and modelling modules ahead of the first
+	job. When gunicorn preloads the app, this happens once in the master and the
+	imported modules are shared copy-on-write by the forked workers.
+	returns: a dictionary of the import time of each module in seconds
+	'''
+
+	for name in MODELLING_MODULES:
+		importModule(name)
+
+	return {name: IMPORT_TIMES[name] for name in MODELLING_MODULES}
+
+
+# The pages, word clouds and summaries of results are kept in a store of bounded size
+ARTIFACT_DIR = os.environ.get('ARTIFACT_DIR', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'artifacts'))
+ARTIFACT_MAX_BYTES = int(os.environ.get('ARTIFACT_MAX_BYTES', str(1024*1024*1024)))
+ARTIFACT_MAX_AGE = int(os.environ.get('ARTIFACT_MAX_AGE', str(30*24*60*60)))
+
+
+# The most disk space the stored models of results and the states of listings may take,
+# and the number of seconds an unused one is kept. The least recently used are removed first
+RESULT_MAX_BYTES = int(os.environ.get('RESULT_MAX_BYTES', str(5*1024*1024*1024)))
+RESULT_MAX_AGE = int(os.environ.get('RESULT_MAX_AGE', str(30*24*60*60)))
+LISTING_MAX_BYTES = int(os.environ.get('LISTING_MAX_BYTES', str(5*1024*1024*1024)))
+LISTING_MAX_AGE = int(os.environ.get('LISTING_MAX_AGE', str(180*24*60*60)))
+
+# Cleaned reviews are kept in a database of bounded size, so they are not cleaned again. 0 disables it
+TOKEN_CACHE_PATH = os.environ.get('TOKEN_CACHE_PATH', os.path.join(os.path.dirname(os.path.realpath(__file__)),
+																  'models', 'tokens.sqlite'))
+TOKEN_CACHE_MAX_BYTES = int(os.environ.get('TOKEN_CACHE_MAX_BYTES', str(256*1024*1024)))
+
+
+def tokenCache(stopwords):
+	'''
+	This function returns the cache of cleaned reviews for a set of stopwords, or
+	None if it is disabled
+	stopwords: the stopwords the reviews are cleaned with
+	'''
+
+	if not TOKEN_CACHE_MAX_BYTES:
+		return None
+
+	TokenCache = importModule('TokenCache')
+	TopicModeling = importModule('TopicModeling')
+
+	return TokenCache.TokenCache(TOKEN_CACHE_PATH, TopicModeling.cleanerKey(stopwords), TOKEN_CACHE_MAX_BYTES)
+
+
+def releaseMemory():
+	'''
+	This function frees the objects no longer referenced and returns the free memory
+	of the heap to the system, so a long-running worker does not keep the memory of
+	a stage once the stage has ended
+	'''
+
+	gc.collect()
+
+	# Only glibc can return the free memory of the heap
+	try:
+		ctypes.CDLL('libc.so.6').malloc_trim(0)
+	except (OSError, AttributeError):
+		pass
+
+
+def pruneModels():
+	'''
+	This function removes the stored models of results and the states of listings
+	beyond their disk space and age limits
+	'''
+
+	ModelStore = importModule('ModelStore')
+
+	filePath = str(os.path.dirname(os.path.realpath(__file__)))
+
+	ModelStore.pruneDirectories(os.path.join(filePath,'models','results'), RESULT_MAX_BYTES, RESULT_MAX_AGE)
+	ModelStore.pruneDirectories(os.path.join(filePath,'models','listings'), LISTING_MAX_BYTES, LISTING_MAX_AGE)
+
+
+def artifacts():
+	'''
+	This function returns the store the artifacts of results are kept in
+	'''
+
+	return ArtifactStore(ARTIFACT_DIR, ARTIFACT_MAX_BYTES, ARTIFACT_MAX_AGE)
+
+
+# The most stored models each process keeps loaded to infer topics with
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', '8'))
+
+# The loaded models of this process, created on first use
+_models = None
+
+
+def inferTopics(filename, texts):
+	'''
+	This function infers the topics of new reviews with the stored model of a
+	result. The model is loaded on first use and kept for later requests.
+	filename: the name the result was saved under
+	texts: a list of reviews as strings
+	returns: a dictionary of the number of topics, the topic shares of each review
+	and the number of words of each review the model knows, or None if the result
+	has no stored model
+	'''
+
+	global _models
+
+	TopicModeling = importModule('TopicModeling')
+	ModelStore = importModule('ModelStore')
+
+	if _models is None:
+		filePath = str(os.path.dirname(os.path.realpath(__file__)))
+		_models = ModelStore.ModelCache(os.path.join(filePath,'models','results'), MODEL_CACHE_SIZE)
+
+	model = _models.get(filename)
+	if model is None:
+		return None
+
+	shares, words = TopicModeling.inferTopics(model['ldamodel'], model['id2word'], texts, model['phraser'],
+											  model['stopwords'])
+
+	return {'num_topics': model['ldamodel'].num_topics, 'documents': shares.round(4).tolist(), 'words': words}
+
 
 def return_something():
 	return 200
 
 
-def LDA(site, inurl1, inurl2, increment_string1, increment_string2, total_pages, increment,filename=''):
+def resultKey(site, inurl1, inurl2, increment_string1, increment_string2, total_pages, increment, **model):
+	'''
+	This function returns the name the results of an analysis are saved under. Analyses
+	with the same parameters get the same name, so their results can be shared.
+	model: the parameters of the model, e.g. numTopics
+	'''
+
+	# Fields of a json submission may be of any type
+	if not all(isinstance(i, str) for i in (site, inurl1, inurl2, increment_string1, increment_string2)):
+		raise TypeError('the site, urls and increment strings must be strings')
+
+	params = {'site': site.strip().lower(),
+			  'url1': inurl1.strip(),
+			  'url2': inurl2.strip(),
+			  'increment_string1': increment_string1.strip(),
+			  'increment_string2': increment_string2.strip(),
+			  'total_pages': int(total_pages),
+			  'increment': int(increment),
+			  'model': model}
+
+	# A canonical serialisation, so equal parameters always give the same hash
+	canonical = json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+	return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:24]
+
+
+def modelOptions(phrase_domain=None, near_duplicates=None):
+	'''
+	This function returns the optional model parameters that are set, to be part of
+	the name of a result. Results of analyses that set none keep their names.
+	'''
+
+	options = {'phrase_domain': phrase_domain, 'near_duplicates': near_duplicates}
+
+	return {k: v for k, v in options.items() if v}
+
+
+def LDA(site, inurl1, inurl2, increment_string1, increment_string2, total_pages, increment,filename='',
+		workers=4, rate_limit=None, use_cache=True, offline=False, progress=None,
+		processes=1, numTopics=3, incremental=True, visualise=False, phrase_domain=None, near_duplicates=None,
+		parsers=0):
 	'''
 	Description: This function accepts a dataframe of house prices and a user provided list to predict the sales price for
 	df: a data frame
 	ls: a list containing the information for a house to predict for
+	workers: the number of pages to fetch concurrently
+	rate_limit: the maximum number of requests per second to the review site
+	use_cache: serve pages from the on-disk page cache
+	offline: serve pages only from the page cache, without the network
+	progress: a function called with the name of each stage as the job advances,
+	and the number of pages read while scraping
+	processes: the number of processes reviews are cleaned in and candidate
+	models are trained in
+	numTopics: the number of topics. None chooses it automatically by coherence
+	incremental: fold new reviews into the stored model of the listing, if there
+	is one, instead of training from scratch
+	visualise: write the pyLDAvis page now. Otherwise only the topic summary is
+	written, and the page is made by visualise when it is first opened
+	phrase_domain: the name of a domain, e.g. attractions, whose listings share one
+	bigram phrase model. It is trained by the first analysis of the domain and
+	reused by the others, which then train none
+	near_duplicates: drop reviews whose words are at least this similar (0 to 1) to
+	an earlier review before modelling. None keeps them. Exact repeats are always dropped
+	parsers: the number of processes pages are parsed in while further pages are
+	fetched. 0 parses pages in the fetching threads
 	'''
 
+	if progress is None:
+		progress = lambda stage, done=None, total=None: None
+
+	WebScraper = importModule('WebScraper')
+	PageCache = importModule('PageCache')
+
 	#inurl1 = "https://www.tripadvisor.co.uk/Attraction_Review-g190384-d6755801-Reviews"
 	#inurl2 = "-The_House_of_Dionysus-Paphos_Paphos_District.html"
 
+	filePath = str(os.path.dirname(os.path.realpath(__file__)))
+
+	cache = None
+	if use_cache or offline:
+		cache = PageCache.PageCache(os.path.join(filePath,'pagecache'), offline=offline)
+
 	ms = WebScraper.WebScraper(site=site,url1=inurl1,
 						  url2=inurl2,increment_string1=increment_string1,increment_string2=increment_string2,
-						  total_pages=int(total_pages),increment=int(increment),silent=False)
+						  total_pages=int(total_pages),increment=int(increment),silent=False,
+						  workers=workers,rate_limit=rate_limit,cache=cache,progress=progress,parsers=parsers)
 
-	ms.fullscraper()
-	
-	filePath = str(os.path.dirname(os.path.realpath(__file__)))
 	if filename=='':
-		for i in range(4):
-			filename = filename + random.choice(string.ascii_letters)
+		model = modelOptions(phrase_domain, near_duplicates)
+		filename = resultKey(site, inurl1, inurl2, increment_string1, increment_string2, total_pages, increment,
+							 numTopics=numTopics, **model)
 
-	myTopicModel = TopicModeling.TopicModeling(ms.all_reviews)
-	
-	del ms
-	
-	myTopicModel.ldaFromReviews()
+	modelListing(ms, filename, progress=progress, processes=processes, numTopics=numTopics,
+				 incremental=incremental, visualise=visualise, phrase_domain=phrase_domain,
+				 near_duplicates=near_duplicates)
+	pruneModels()
+
+	# Return the name the results were saved under
+	return filename
+
+
+def modelListing(ms, filename, progress, processes=1, numTopics=3, incremental=True, visualise=False,
+				 phrase_domain=None, window=None, executor=None, stopwords=None, keep_cleaned=False,
+				 near_duplicates=None):
+	'''
+	This function scrapes the reviews of a listing, models them and saves the results.
+	ms: the WebScraper of the listing
+	filename: the name the results are saved under
+	progress: a function called with the name of each stage as the job advances
+	window: the pages of the listing already started by ms.startPages, if any
+	executor: a cleaning pool to share between listings
+	stopwords: the stopwords, to share them between listings
+	keep_cleaned: return the cleaned reviews of the listing
+	returns: all cleaned reviews of the listing if keep_cleaned, otherwise None
+	The other arguments are those of LDA.
+	'''
+
+	TopicModeling = importModule('TopicModeling')
+	ModelStore = importModule('ModelStore')
+
+	filePath = str(os.path.dirname(os.path.realpath(__file__)))
+
+	if stopwords is None:
+		stopwords = TopicModeling.loadStopwords()
+
+	# The corpus is memory-mapped from the directory the result is stored in
+	resultDir = os.path.join(filePath,'models','results',filename)
+
+	# The stored model of this listing, if it has been analysed before
+	state = ModelStore.ListingState(os.path.join(filePath,'models','listings'), ms.site, ms.url1, ms.url2)
+	previous = state.load() if incremental else None
+
+	# The shared phrase model of the domain, if it has been trained
+	phraserDir = os.path.join(filePath,'models','phrasers')
+	phraser = ModelStore.loadPhraser(phraserDir, phrase_domain) if phrase_domain else None
+
+	# Reviews are cleaned page by page while the later pages are downloading.
+	# For a known listing, only the pages with new reviews are read, unless more
+	# pages are asked for than earlier analyses read. States stored before the
+	# pages were recorded read every page once
+	batches = ms.iterpages(window=window)
+	if previous is not None:
+		batches = ModelStore.newReviews(batches, previous['seen'], stop=ms.total_pages <= previous.get('pages', 0))
+
+	myTopicModel = TopicModeling.TopicModeling.fromBatches(batches, executor=executor, processes=processes,
+														   corpus_dir=resultDir, phraser=phraser,
+														   stopwords=stopwords, token_cache=tokenCache(stopwords))
+
+	if near_duplicates:
+		print('Dropped {} near duplicate reviews'.format(myTopicModel.dropNearDuplicates(near_duplicates)))
+
+	cleaned = list(myTopicModel.df['cleaned'])
+	hashes = [ModelStore.reviewHash(i) for i in myTopicModel.df['fullreview']]
+	releaseMemory()
+
+	progress('modelling')
+	if previous is not None and not state.needsRebuild(previous, cleaned, numTopics):
+		print('Updating the model with {} new reviews'.format(len(cleaned)))
+		bigrams = previous['bigrams'] if phraser is None else phraser
+		myTopicModel.foldIn(previous['ldamodel'], previous['id2word'], bigrams, previous['corpus'],
+							visualise=visualise)
+		rebuilt = False
+	else:
+		if previous is not None:
+			print('Rebuilding the model with {} new reviews'.format(len(cleaned)))
+			myTopicModel = TopicModeling.TopicModeling.fromCleaned(previous['cleaned'] + cleaned, processes=processes,
+																   corpus_dir=resultDir, phraser=phraser,
+																   stopwords=stopwords)
+
+		myTopicModel.ldaFromReviews(numTopics=numTopics, processes=processes, patience=1, visualise=visualise)
+		rebuilt = True
+
+	# The reviews are only needed to build the model
+	myTopicModel.releaseReviews()
+	releaseMemory()
+
+	if previous is not None:
+		cleaned = previous['cleaned'] + cleaned
+		hashes = previous['hashes'] + hashes
+
+	state.save(myTopicModel, cleaned, hashes, rebuilt, previous, pages=ms.total_pages)
+	if phrase_domain and phraser is None:
+		ModelStore.savePhraser(phraserDir, phrase_domain, TopicModeling.freezePhrases(myTopicModel.bigrams))
+	if not keep_cleaned:
+		cleaned = None
+	del previous, hashes
+	releaseMemory()
+	progress('wordcloud')
 	myTopicModel.generate_wordcloud()
-	myTopicModel.saveLDA(os.path.join(filePath,'templates/LDAhtmls',filename + '1' + '.html'))
-	myTopicModel.saveWordcloud(os.path.join(filePath,'static',filename + '2' + '.png'))
+	progress('saving')
+	ModelStore.saveResult(resultDir, myTopicModel)
+	saveArtifacts(myTopicModel, filename, visualise)
 	
 	del myTopicModel
+	releaseMemory()
+
+	return cleaned
+
+
+def saveArtifacts(myTopicModel, filename, visualise=False):
+	'''
+	This function saves the word cloud, the topic summary, the topics of each review
+	and, if asked for, the pyLDAvis page of a result to the artifact store
+	myTopicModel: the TopicModeling object of the result, with its word cloud generated
+	filename: the name the results are saved under
+	visualise: write the pyLDAvis page
+	'''
+
+	store = artifacts()
+	if visualise:
+		with store.writing(filename + '1' + '.html') as path:
+			myTopicModel.saveLDA(path)
+	with store.writing(filename + '2' + '.png') as path:
+		myTopicModel.saveWordcloud(path)
+
+	shares = myTopicModel.topicShares()
+	with store.writing(filename + '4' + '.json') as path:
+		myTopicModel.saveDocumentTopics(path, shares)
+
+	# The summary is written last, since it marks the result as complete
+	with store.writing(filename + '3' + '.json') as path:
+		myTopicModel.saveSummary(path, shares=shares)
+
+
+def listingResultKey(listing, **model):
+	'''
+	This function returns the name the results of one listing of a batch are saved under
+	listing: a dictionary of the site, url1, url2, increment_string1, increment_string2,
+	total_pages and increment of the listing
+	model: the parameters of the model, e.g. numTopics
+	'''
+
+	return resultKey(listing['site'], listing['url1'], listing['url2'], listing['increment_string1'],
+					 listing.get('increment_string2', ''), listing['total_pages'], listing['increment'], **model)
+
+
+def batchKey(listings, combined=False, **model):
+	'''
+	This function returns the name the results of a batch of listings are saved under
+	listings: a list of listing dictionaries, as for listingResultKey
+	combined: whether the batch has a model of all of its listings together
+	model: the parameters of the model, e.g. numTopics
+	'''
+
+	params = {'listings': [listingResultKey(i, **model) for i in listings], 'combined': bool(combined)}
+	canonical = json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+	return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:24]
+
+
+def batchLDA(listings, filename='', workers=4, rate_limit=None, use_cache=True, offline=False, progress=None,
+			 processes=1, numTopics=3, incremental=True, visualise=False, phrase_domain=None, combined=False,
+			 prefetch=2, near_duplicates=None, parsers=0):
+	'''
+	This function analyses a batch of listings in one job. The listings share one
+	page fetching pool, connection pool and per host rate limiter, and every
+	listing keeps a few pages in flight from the start, so the pages of listings
+	on different hosts are fetched side by side within each host's limit. The
+	stopwords, the cleaning processes and the phrase model of the domain are
+	shared as well. Each listing is saved as if analysed by LDA, and a listing
+	that fails does not stop the others.
+	listings: a list of dictionaries of the site, url1, url2, increment_string1,
+	increment_string2 (optional), total_pages and increment of each listing
+	combined: also train a model of the reviews of all listings together, saved
+	under the name of the batch
+	prefetch: the number of pages each listing keeps in flight
+	The other arguments are those of LDA.
+	returns: a dictionary of the name of the batch, the result of each listing
+	and the name of the combined result, if any
+	'''
+
+	if progress is None:
+		progress = lambda stage, done=None, total=None: None
+
+	from concurrent.futures import ThreadPoolExecutor
+	import traceback
+
+	JobQueue = importModule('JobQueue')
+	WebScraper = importModule('WebScraper')
+	TopicModeling = importModule('TopicModeling')
+	PageCache = importModule('PageCache')
+	ModelStore = importModule('ModelStore')
+
+	filePath = str(os.path.dirname(os.path.realpath(__file__)))
+
+	model = modelOptions(phrase_domain, near_duplicates)
+	if filename=='':
+		filename = batchKey(listings, combined, numTopics=numTopics, **model)
+
+	cache = None
+	if use_cache or offline:
+		cache = PageCache.PageCache(os.path.join(filePath,'pagecache'), offline=offline)
+
+	# The resources shared by every listing. The parsing processes are started before any threads
+	parse_pool = WebScraper.createParsePool(parsers) if parsers else None
+	limiter = WebScraper.RateLimiter(rate_limit if rate_limit is not None else 1.0)
+	session = WebScraper.createSession(workers)
+	fetcher = ThreadPoolExecutor(max_workers=workers)
+	stopwords = TopicModeling.loadStopwords()
+	cleaner = TopicModeling.cleaningPool(stopwords, processes)
+
+	scrapers = [WebScraper.WebScraper(site=i['site'],url1=i['url1'],url2=i['url2'],
+									  increment_string1=i['increment_string1'],
+									  increment_string2=i.get('increment_string2', ''),
+									  total_pages=int(i['total_pages']),increment=int(i['increment']),silent=False,
+									  workers=workers,rate_limiter=limiter,session=session,cache=cache,
+									  executor=fetcher,parse_pool=parse_pool)
+				for i in listings]
+
+	results = []
+	cleaned = [] if combined else None
+	windows = []
+
+	try:
+		# Every listing starts fetching its first pages now
+		windows = [ms.startPages(prefetch) if ms.site.lower() in ms.supported_sites else None for ms in scrapers]
+
+		for n, listing in enumerate(listings):
+			ms = scrapers[n]
+			name = listingResultKey(listing, numTopics=numTopics, **model)
+
+			def stage(step, done=None, total=None, n=n):
+				progress('listing {}/{}: {}'.format(n + 1, len(listings), step), done, total)
+
+			ms.progress = stage
+
+			try:
+				docs = modelListing(ms, name, stage, processes=processes, numTopics=numTopics,
+									incremental=incremental, visualise=visualise, phrase_domain=phrase_domain,
+									window=windows[n], executor=cleaner, stopwords=stopwords,
+									keep_cleaned=combined, near_duplicates=near_duplicates)
+				results.append({'listing': listing, 'result': name, 'failed_pages': len(ms.failed_pages),
+								'duplicates': ms.duplicates})
+				if combined:
+					cleaned.extend(docs)
+			except JobQueue.JobCancelled:
+				raise
+			except Exception as e:
+				traceback.print_exc()
+				results.append({'listing': listing, 'result': None, 'error': repr(e)})
+
+			# The scraper of a finished listing is not needed any more
+			scrapers[n] = None
+
+		combinedName = None
+		if combined and cleaned:
+			progress('combined model')
+			phraser = ModelStore.loadPhraser(os.path.join(filePath,'models','phrasers'), phrase_domain) \
+				if phrase_domain else None
+			resultDir = os.path.join(filePath,'models','results',filename)
+
+			myTopicModel = TopicModeling.TopicModeling.fromCleaned(cleaned, processes=processes, corpus_dir=resultDir,
+																   phraser=phraser, stopwords=stopwords)
+			del cleaned
+			myTopicModel.ldaFromReviews(numTopics=numTopics, processes=processes, patience=1, visualise=visualise)
+			myTopicModel.generate_wordcloud()
+			ModelStore.saveResult(resultDir, myTopicModel)
+			saveArtifacts(myTopicModel, filename, visualise)
+			combinedName = filename
+	finally:
+		for window in windows:
+			if window is not None:
+				window.cancel()
+		fetcher.shutdown(wait=True)
+		if parse_pool is not None:
+			parse_pool.shutdown()
+		if cleaner is not None:
+			cleaner.shutdown()
+
+	pruneModels()
+
+	return {'id': filename, 'listings': results, 'combined': combinedName}
+
+
+def hasStoredModel(filename):
+	'''
+	This function checks whether a result has a stored model to visualise
+	filename: the name the results were saved under
+	'''
+
+	filePath = str(os.path.dirname(os.path.realpath(__file__)))
+
+	return os.path.exists(os.path.join(filePath,'models','results',filename,'lda'))
+
+
+def visualise(filename, progress=None):
+	'''
+	This function makes the pyLDAvis page of a result from its stored model, for
+	results that were saved with only a topic summary. It is run as a job, since
+	preparing the page takes as long as training a model.
+	filename: the name the results were saved under
+	progress: a function called with the name of each stage as the job advances
+	returns: True if the page was made, False if the result has no stored model
+	'''
+
+	if progress is not None:
+		progress('visualising')
+
+	TopicModeling = importModule('TopicModeling')
+	ModelStore = importModule('ModelStore')
+	import pyLDAvis
+
+	filePath = str(os.path.dirname(os.path.realpath(__file__)))
+
+	result = ModelStore.loadResult(os.path.join(filePath,'models','results',filename))
+	if result is None:
+		return False
+
+	vis = TopicModeling.pyLDAvisGensim().prepare(result['ldamodel'], result['corpus'], result['id2word'])
+	with artifacts().writing(filename + '1' + '.html') as path:
+		pyLDAvis.save_html(vis, path)
 
-	# # Return the predicted Sale Price
-	return None
+	return True
@@ -0,0 +1,406 @@
+'''
+Low overhead timing and resource metrics of the scraping and modelling stages.
+
+Each stage is timed with a context manager that records its duration, the
+number of items it handled and the peak memory of the process when it ended.
+The peak memory of a process only grows, so the first stage whose peak is
+large shows where the memory went. The totals
+of each process can be written to the metrics directory, so the /metrics
+route can report the stages run in job processes as well as its own.
+
+Example Usage:
+with metrics.stage('parse') as s:
+    rows = parse(page)
+    s.items = len(rows)
+metrics.count('bytes_fetched', len(page))
+'''
+
+from contextlib import contextmanager
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+
+METRICS_DIR = os.environ.get('METRICS_DIR', 'metrics')
+
+# The totals of a process that has not written them for this many seconds are dropped
+METRICS_MAX_AGE = int(os.environ.get('METRICS_MAX_AGE', str(7*24*60*60)))
+
+_lock = threading.Lock()
+
+# stage -> [calls, seconds, items, slowest call in seconds, largest peak memory of the process at its end]
+_stages = {}
+
+# counter name -> value
+_counters = {}
+
+# queue name -> [current depth, deepest, sum of the depths observed, number of observations]
+_depths = {}
+
+# The stages of the current job, as (stage, seconds, items, peak memory) in the order they ran
+_job = None
+
+# The largest peak resident memory of the finished processes whose totals were absorbed
+_absorbed_peak = 0
+
+
+class Stage:
+    """
+    The record of a stage that is being timed. The items handled by the stage
+    can be set while it runs.
+    """
+
+    def __init__(self, name, items = 0):
+        self.name = name
+        self.items = items
+
+
+def peakRss(children = False):
+    '''
+    This function returns the peak resident memory of this process in bytes
+    children: return that of the largest finished child process instead, such as
+    a worker of a cleaning or parsing pool
+    '''
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def stage(name, items = 0):
+    '''
+    This function times a stage
+    name: the name of the stage
+    items: the number of items handled by the stage, if known in advance
+    '''
+
+    record = Stage(name, items)
+    start = time.perf_counter()
+
+    try:
+        yield record
+    finally:
+        timed(name, time.perf_counter() - start, record.items or 0)
+
+
+def timed(name, seconds, items = 0):
+    '''
+    This function records a call of a stage timed by the caller, e.g. one that
+    starts in one thread and ends in another, with the peak memory of the process
+    as it ends
+    name: the name of the stage
+    seconds: the duration of the call
+    items: the number of items handled by the call
+    '''
+
+    peak = peakRss()
+
+    with _lock:
+        _addStage(_stages, name, 1, seconds, items, seconds, peak)
+
+        if _job is not None:
+            _job.append((name, seconds, items, peak))
+
+
+def _addStage(stages, name, calls, seconds, items, slowest, peak = 0):
+    '''
+    This function adds calls of a stage to a dictionary of stage totals
+    '''
+
+    totals = stages.setdefault(name, [0, 0.0, 0, 0.0, 0])
+    totals[0] += calls
+    totals[1] += seconds
+    totals[2] += items
+    totals[3] = max(totals[3], slowest)
+    totals[4] = max(totals[4], peak)
+
+
+def count(name, value = 1):
+    '''
+    This function adds to a counter
+    name: the name of the counter
+    value: the amount to add
+    '''
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def _record(name, value):
+    # The caller holds the lock
+    depths = _depths.setdefault(name, [0, 0, 0, 0])
+    depths[0] = value
+    depths[1] = max(depths[1], value)
+    depths[2] += value
+    depths[3] += 1
+
+
+def observe(name, value):
+    '''
+    This function records the depth of a queue, e.g. the pages waiting to be parsed
+    name: the name of the queue
+    value: the number of items in the queue
+    '''
+
+    with _lock:
+        _record(name, value)
+
+
+@contextmanager
+def depth(name):
+    '''
+    This function counts an item into a queue for the duration of a block, recording
+    the depth of the queue as it enters
+    name: the name of the queue
+    '''
+
+    enter(name)
+
+    try:
+        yield
+    finally:
+        leave(name)
+
+
+def enter(name):
+    '''
+    This function counts an item into a queue, recording the depth of the queue as
+    it enters. Each call is matched by a call of leave.
+    name: the name of the queue
+    '''
+
+    with _lock:
+        _record(name, _depths.get(name, [0])[0] + 1)
+
+
+def leave(name):
+    '''
+    This function counts an item out of a queue
+    name: the name of the queue
+    '''
+
+    with _lock:
+        _depths[name][0] -= 1
+
+
+def startJob():
+    '''
+    This function starts collecting the stages of a job run in this process
+    '''
+
+    global _job
+    with _lock:
+        _job = []
+
+
+def finishJob(isolated = False):
+    '''
+    This function stops collecting the stages of the current job
+    isolated: whether the job ran in a process of its own. The peak memory of the
+    process is then that of the job, otherwise it is the peak of the worker over
+    all of the jobs it has run, and is reported as worker_peak_rss
+    returns: a json serialisable breakdown of the time spent in each stage of
+    the job and the peak memory of the process as it ended, and the peak memory
+    of the process and of its largest finished child
+    '''
+
+    global _job
+    with _lock:
+        job, _job = _job or [], None
+
+    peak_rss = 'peak_rss' if isolated else 'worker_peak_rss'
+
+    breakdown = {}
+    for name, seconds, items, peak in job:
+        totals = breakdown.setdefault(name, {'seconds': 0.0, 'items': 0, 'calls': 0, peak_rss: 0})
+        totals['seconds'] += seconds
+        totals['items'] += items
+        totals['calls'] += 1
+        totals[peak_rss] = max(totals[peak_rss], peak)
+
+    memory = {'peak_rss': peakRss(), 'peak_rss_children': peakRss(children=True)}
+    if not isolated:
+        memory = {'worker_' + k: v for k, v in memory.items()}
+
+    return dict(memory, stages=breakdown)
+
+
+def snapshot():
+    '''
+    This function returns the totals of this process
+    '''
+
+    with _lock:
+        return {'pid': os.getpid(),
+                'stages': {k: list(v) for k, v in _stages.items()},
+                'counters': dict(_counters),
+                'depths': {k: v[1:] for k, v in _depths.items()},
+                'peak_rss': max(peakRss(), _absorbed_peak)}
+
+
+def flush(directory = None):
+    '''
+    This function writes the totals of this process to the metrics directory
+    directory: the metrics directory. Defaults to METRICS_DIR
+    '''
+
+    directory = directory or METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    fd, temp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(temp, os.path.join(directory, '{}.json'.format(os.getpid())))
+
+
+def reset():
+    '''
+    This function clears the totals of this process, e.g. in a forked process that
+    must not report the totals of its parent again
+    '''
+
+    global _absorbed_peak
+
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _depths.clear()
+        _absorbed_peak = 0
+
+
+def absorb(pid, directory = None):
+    '''
+    This function adds the totals a finished process wrote to the metrics directory
+    to those of this process and removes its file, so processes that run a single
+    job do not each leave a file behind
+    pid: the process id of the finished process
+    directory: the metrics directory. Defaults to METRICS_DIR
+    '''
+
+    global _absorbed_peak
+
+    directory = directory or METRICS_DIR
+    path = os.path.join(directory, '{}.json'.format(pid))
+
+    try:
+        with open(path) as f:
+            snap = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    with _lock:
+        for name, totals in snap['stages'].items():
+            _addStage(_stages, name, *totals)
+
+        for name, value in snap['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+
+        for name, (deepest, total, samples) in snap.get('depths', {}).items():
+            depth = _depths.setdefault(name, [0, 0, 0, 0])
+            depth[1] = max(depth[1], deepest)
+            depth[2] += total
+            depth[3] += samples
+
+        _absorbed_peak = max(_absorbed_peak, snap['peak_rss'])
+
+    # The totals are written out before the file is removed, so they are never missing
+    flush(directory)
+    os.remove(path)
+
+
+def collect(directory = None):
+    '''
+    This function returns the totals of this process and of every process that has
+    written to the metrics directory. The files of processes that have not written
+    for METRICS_MAX_AGE seconds, and files left behind by interrupted writes, are
+    removed.
+    directory: the metrics directory. Defaults to METRICS_DIR
+    '''
+
+    directory = directory or METRICS_DIR
+    snapshots = [snapshot()]
+    now = time.time()
+
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+
+            try:
+                age = now - os.path.getmtime(path)
+                if (METRICS_MAX_AGE and age > METRICS_MAX_AGE) or (name.startswith('tmp') and age > 60*60):
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+
+            if not name.endswith('.json') or name == '{}.json'.format(os.getpid()):
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+
+    return snapshots
+
+
+def render(directory = None, gauges = None):
+    '''
+    This function renders the metrics of all processes in the Prometheus text format
+    directory: the metrics directory. Defaults to METRICS_DIR
+    gauges: a dictionary of further gauges, e.g. import times, by name and label
+    '''
+
+    stages = {}
+    counters = {}
+    depths = {}
+    peak = 0
+
+    for snap in collect(directory):
+        # Files written before the peak memory of each stage was recorded have four totals
+        for name, totals in snap['stages'].items():
+            _addStage(stages, name, *totals)
+        for name, value in snap['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, (deepest, total, samples) in snap.get('depths', {}).items():
+            totals = depths.setdefault(name, [0, 0, 0])
+            totals[0] = max(totals[0], deepest)
+            totals[1] += total
+            totals[2] += samples
+        peak = max(peak, snap['peak_rss'])
+
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append('# HELP app_{} {}'.format(name, help))
+        lines.append('# TYPE app_{} {}'.format(name, kind))
+        for labels, value in samples:
+            lines.append('app_{}{} {}'.format(name, labels, value))
+
+    def labelled(index):
+        return [('{{stage="{}"}}'.format(k), v[index]) for k, v in sorted(stages.items())]
+
+    metric('stage_calls_total', 'counter', 'Number of times each stage ran.', labelled(0))
+    metric('stage_seconds_total', 'counter', 'Time spent in each stage.', labelled(1))
+    metric('stage_items_total', 'counter', 'Items handled by each stage.', labelled(2))
+    metric('stage_seconds_max', 'gauge', 'Longest single run of each stage.', labelled(3))
+    metric('stage_peak_rss_bytes', 'gauge', 'Largest peak resident memory of a process as each stage ended.',
+           labelled(4))
+
+    for name, value in sorted(counters.items()):
+        metric(name + '_total', 'counter', 'Total {}.'.format(name.replace('_', ' ')), [('', value)])
+
+    metric('queue_depth_max', 'gauge', 'Deepest each queue has been.',
+           [('{{queue="{}"}}'.format(k), v[0]) for k, v in sorted(depths.items())])
+    metric('queue_depth_mean', 'gauge', 'Mean depth of each queue as items entered it.',
+           [('{{queue="{}"}}'.format(k), v[1] / v[2] if v[2] else 0) for k, v in sorted(depths.items())])
+
+    metric('peak_rss_bytes', 'gauge', 'Largest peak resident memory of any process.', [('', peak)])
+
+    for name, samples in sorted((gauges or {}).items()):
+        metric(name, 'gauge', name.replace('_', ' ').capitalize() + '.',
+               [('{{name="{}"}}'.format(k), v) for k, v in sorted(samples.items())])
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,50 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import WebScraper
+
+
+class Response:
+    '''
+    A successful response of the session below
+    '''
+
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+
+class Session:
+    '''
+    A session serving saved pages by url instead of fetching them
+    '''
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get(self, url, timeout = None, headers = None):
+        return Response(self.pages[url])
+
+
+def test_empty_page_is_retried_in_parsing_processes():
+    with open(os.path.join(ROOT, 'benchmarks', 'fixtures', 'tripadvisor.html'), 'rb') as f:
+        content = f.read()
+
+    ms = WebScraper.WebScraper(site='tripadvisor', url1='https://example.com/Reviews', url2='.html',
+                               increment_string1='-or', total_pages=2, increment=10, seconds_wait=0,
+                               workers=2, max_attempts=2, backoff=0, parsers=2)
+    ms.session = Session({ms.pageUrl(0): b'', ms.pageUrl(1): content})
+
+    frames = list(ms.iterpages())
+
+    # The empty page fails after its attempts without failing the other page
+    assert len(frames) == 1 and len(frames[0])
+    assert [(i['page'], i['attempts']) for i in ms.failed_pages] == [(0, 2)]
+    assert 'ValueError' in ms.failed_pages[0]['error']
@@ -1,13 +1,119 @@
-from flask import Flask, request, redirect, url_for, render_template, jsonify, send_from_directory
+import time
+_start = time.perf_counter()
+
+from flask import Flask, Response, request, redirect, url_for, render_template, jsonify, send_file
 from functions import *
-import pandas as pd
-import os
-import string
-import random
+import JobQueue
+import config
+import json
+import metrics
+import mimetypes
+import re
 
 # This line sets the app directory as the working directory
 application = Flask(__name__)
 
+# Import the modelling stack now rather than in the first job
+if config.warm_imports:
+    for name, seconds in warmup().items():
+        print('Imported {} in {:.2f}s'.format(name, seconds))
+
+# The time taken to import the app
+IMPORT_TIMES['wsgi'] = time.perf_counter() - _start
+print('Loaded the app in {:.2f}s'.format(IMPORT_TIMES['wsgi']))
+
+# The queue of scrape and model jobs run in the background
+jobs = JobQueue.JobQueue(config.job_dir, workers=config.job_workers, max_pending=config.job_queue_size,
+                        isolated=config.low_memory_jobs, memory_limit=config.job_memory_limit_mb*1024*1024,
+                        max_age=config.job_max_age)
+
+# The pages, word clouds and summaries of results
+store = artifacts()
+
+# Job ids become file names, so only plain names are accepted
+JOB_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def formOptions(form):
+    '''
+    This function returns the optional model parameters the analysis a form asks for
+    sets, falling back to those of the config
+    form: the request form
+    '''
+
+    domain = form.get('phrase_domain') or config.phrase_domain
+    if domain and not JOB_ID.match(domain):
+        raise ValueError('invalid phrase domain')
+
+    near_duplicates = float(form.get('near_duplicates') or config.near_duplicates)
+    if not 0 <= near_duplicates <= 1:
+        raise ValueError('invalid near_duplicates')
+
+    return modelOptions(domain, near_duplicates)
+
+
+def formKey(form):
+    '''
+    This function returns the name of the results of the analysis a form asks for
+    form: the request form
+    '''
+
+    return resultKey(form['site'], form['url1'], form['url2'], form['increment_string1'],
+                     form.get('increment_string2', ''), form['total_pages'], form['increment'], numTopics=3,
+                     **formOptions(form))
+
+
+def resultIsFresh(filename):
+    '''
+    This function checks whether the results saved under a name can still be served
+    filename: the name of the results
+    '''
+
+    age = store.age(filename + '3.json')
+
+    return age is not None and age < config.result_ttl
+
+
+def serveArtifact(name):
+    '''
+    This function sends an artifact as it is stored, compressed if the client
+    accepts gzip. Clients can revalidate it with its ETag.
+    name: the name of the artifact
+    '''
+
+    try:
+        found = store.open(name, accept_gzip='gzip' in request.accept_encodings)
+    except ValueError:
+        return 'invalid artifact', 400
+
+    if found is None:
+        return 'not found', 404
+
+    path, encoding = found
+
+    response = send_file(path, mimetype=mimetypes.guess_type(name)[0], conditional=True,
+                         cache_timeout=config.artifact_cache_seconds)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+
+    return response
+
+
+def submitLDA(form):
+    '''
+    This function queues an LDA job from the fields of a submitted form. Identical
+    submissions share the job that is already queued or running.
+    form: the request form
+    returns: the id of the job
+    '''
+
+    filename = formKey(form)
+
+    return jobs.submit(LDA, form['site'], form['url1'], form['url2'], form['increment_string1'],
+                       form.get('increment_string2', ''), int(form['total_pages']), int(form['increment']),
+                       filename, numTopics=3, parsers=config.parse_processes, job_id=filename, **formOptions(form))
+
 
 # The home route
 @application.route('/', methods=['GET'])
@@ -16,18 +122,60 @@ def home_page():
     return redirect('/dosomething2')
 
 
-# The dosomething route
+# The showresult route
 @application.route('/showresult', methods=['GET'])
 def showresult():
-    filename = request.args.get('filename')
+    filename = request.args.get('filename', '')
+    if not JOB_ID.match(filename):
+        return 'invalid filename', 400
+
+    summary = store.open(filename + '3.json')
+    wordcloud = url_for('artifact', name=filename + '2.png')
+
+    if summary is None:
+        return 'File is not ready yet!'
+
+    with open(summary[0]) as f:
+        topics = json.load(f)['topics']
+
+    # Show the top terms of each topic and the word cloud
+    return render_template('ShowSummary.html', filename=filename, topics=topics, wordcloud=wordcloud)
+
+
+# The full visualisation route
+@application.route('/ldavis', methods=['GET'])
+def ldavis():
+    filename = request.args.get('filename', '')
+    if not JOB_ID.match(filename):
+        return 'invalid filename', 400
+
     ldafile = filename + '1.html'
-    wordcloud = 'static/' + filename + '2.png'
 
-    if not os.path.exists('templates/LDAhtmls/' + ldafile):
+    # Send the stored page rather than rendering it again
+    if store.exists(ldafile):
+        return serveArtifact(ldafile)
+
+    if not hasStoredModel(filename):
         return 'File is not ready yet!'
 
-    # Show something
-    return render_template('ShowResult.html', ldafile=ldafile, wordcloud=wordcloud)
+    # A visualisation that just failed is not retried on every refresh
+    status = jobs.status(filename + '-ldavis')
+    if status is not None and status.get('state') == 'failed' and time.time() - status.get('finished', 0) < 60:
+        return 'The visualisation could not be made.', 500
+
+    # The visualisation is made in a job the first time it is asked for, and the page polls until it is stored
+    try:
+        jobs.submit(visualise, filename, job_id=filename + '-ldavis')
+    except JobQueue.QueueFull:
+        return 'The server is busy, please try again in a few minutes.', 503, {'Retry-After': '60'}
+
+    return 'The visualisation is being made, this page will refresh when it is ready.', 202, {'Refresh': '5'}
+
+
+# The artifact route
+@application.route('/artifacts/<name>', methods=['GET'])
+def artifact(name):
+    return serveArtifact(name)
 
 
 # The dosomething2 route
@@ -43,9 +191,11 @@ def dosomething2():
         total_pages = request.form['total_pages']
         increment = request.form['increment']
         site = request.form['site']
-        filename = ''
-        for i in range(4):
-            filename = filename + random.choice(string.ascii_letters)
+
+        try:
+            filename = formKey(request.form)
+        except (KeyError, TypeError, ValueError) as e:
+            return 'invalid field {}'.format(e), 400
 
         return render_template('waiting.html', url1=url1, url2=url2, increment_string1=increment_string1,
                                increment_string2=increment_string2, total_pages=total_pages, increment=increment,
@@ -58,21 +208,135 @@ def dosomething2():
 # The process route
 @application.route('/process', methods=['POST'])
 def process():
-    url1 = request.form['url1']
-    url2 = request.form['url2']
-    increment_string1 = request.form['increment_string1']
-    increment_string2 = request.form['increment_string2']
-    total_pages = int(request.form['total_pages'])
-    increment = int(request.form['increment'])
-    site = request.form['site']
-    filename = request.form['filename']
+    try:
+        filename = formKey(request.form)
+
+        if resultIsFresh(filename):
+            return 'duplicate'
+
+        submitLDA(request.form)
+    except (KeyError, TypeError, ValueError) as e:
+        return 'invalid field {}'.format(e), 400
+    except JobQueue.QueueFull:
+        return 'busy', 503, {'Retry-After': '60'}
+
+    return 'queued'
+
+
+# The job submission route
+@application.route('/jobs', methods=['POST'])
+def submit_job():
+    form = request.get_json(silent=True) or request.form.to_dict()
+
+    try:
+        job_id = formKey(form)
+
+        # A fresh result of the same analysis is served instead of running it again
+        if resultIsFresh(job_id):
+            return jsonify(id=job_id, state='done', result=job_id,
+                           status=url_for('job_status', job_id=job_id)), 200
+
+        job_id = submitLDA(form)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify(error='invalid field {}'.format(e)), 400
+    except JobQueue.QueueFull as e:
+        return jsonify(error=str(e)), 503, {'Retry-After': '60'}
+
+    return jsonify(id=job_id, status=url_for('job_status', job_id=job_id)), 202
+
+
+# The batch submission route
+@application.route('/jobs/batch', methods=['POST'])
+def submit_batch():
+    body = request.get_json(silent=True) or {}
+
+    try:
+        listings = body['listings']
+        if not isinstance(listings, list) or not listings:
+            raise ValueError('listings')
+        if len(listings) > config.batch_max_listings:
+            return jsonify(error='at most {} listings'.format(config.batch_max_listings)), 400
+
+        # Each listing is checked the same way as a single submission
+        listings = [{'site': i['site'], 'url1': i['url1'], 'url2': i['url2'],
+                     'increment_string1': i['increment_string1'], 'increment_string2': i.get('increment_string2', ''),
+                     'total_pages': int(i['total_pages']), 'increment': int(i['increment'])} for i in listings]
+
+        combined = bool(body.get('combined', False))
+        model = formOptions(body)
+        job_id = batchKey(listings, combined, numTopics=3, **model)
+
+        jobs.submit(batchLDA, listings, job_id, numTopics=3, combined=combined, parsers=config.parse_processes,
+                    job_id=job_id, **model)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify(error='invalid field {}'.format(e)), 400
+    except JobQueue.QueueFull as e:
+        return jsonify(error=str(e)), 503, {'Retry-After': '60'}
+
+    return jsonify(id=job_id, status=url_for('job_status', job_id=job_id),
+                   results=[listingResultKey(i, numTopics=3, **model) for i in listings],
+                   combined=job_id if combined else None), 202
+
+
+# The job status route
+@application.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    status = jobs.status(job_id) if JOB_ID.match(job_id) else None
+
+    if status is None:
+        return jsonify(error='unknown job'), 404
+
+    return jsonify(status)
+
+
+# The job progress route
+@application.route('/jobs/<job_id>/progress', methods=['GET'])
+def job_progress(job_id):
+    status = jobs.status(job_id) if JOB_ID.match(job_id) else None
+
+    if status is None:
+        return jsonify(error='unknown job'), 404
+
+    return jsonify(id=job_id, state=status.get('state'), **status.get('progress', {}))
+
+
+# The job cancel route
+@application.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    status = jobs.cancel(job_id) if JOB_ID.match(job_id) else None
+
+    if status is None:
+        return jsonify(error='unknown job'), 404
+
+    return jsonify(status)
+
+
+# The topic inference route
+@application.route('/models/<name>/topics', methods=['POST'])
+def infer_topics(name):
+    if not JOB_ID.match(name):
+        return jsonify(error='unknown model'), 404
+
+    body = request.get_json(silent=True) or {}
+    texts = body.get('texts')
+
+    if not isinstance(texts, list) or not all(isinstance(i, str) for i in texts):
+        return jsonify(error='texts must be a list of strings'), 400
+    if len(texts) > config.inference_max_texts:
+        return jsonify(error='at most {} texts'.format(config.inference_max_texts)), 400
+
+    result = inferTopics(name, texts)
+    if result is None:
+        return jsonify(error='unknown model'), 404
 
-    if os.path.exists('templates/LDAhtmls/' + filename + '1.html'):
-        return 'duplicate'
+    return jsonify(model=name, **result)
 
-    LDA(site, url1, url2, increment_string1, increment_string2, total_pages, increment, filename)
 
-    return 'done'
+# The metrics route
+@application.route('/metrics', methods=['GET'])
+def metrics_page():
+    return Response(metrics.render(gauges={'import_seconds': IMPORT_TIMES}),
+                    mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':